@@ -1,12 +1,12 @@
 # -*- coding: utf-8 -*-
-from dash import Dash, dcc, html, dash_table, Input, Output, State, callback_context, clientside_callback
+from dash import Dash, dcc, html, dash_table, Input, Output, State, callback_context, clientside_callback, no_update
 import dash_bootstrap_components as dbc
 import plotly.graph_objects as go
-import pandas as pd
-import os
-import package_root
-from src.plotting import pie_chart, line_chart
-from src.utils import extract_credit_card_data, get_spending, get_totals, get_income, extract_bank_data, update_investment_data, get_total_assets
+import threading
+from src.plotting import ledger_pie_chart, ledger_line_chart, theme_patch, zoomed_range
+from src.storage import ledger_store, ledger_exists, ledger_version, get_layout, to_dollars
+from src.utils import get_summary, update_investment_data, get_total_assets, pushdown_stem
+from src.jobs import start_ingestion, job_progress
 
 
 app = Dash(
@@ -14,25 +14,13 @@ app = Dash(
     external_stylesheets=[dbc.themes.LITERA, dbc.icons.FONT_AWESOME],
 )
 
-##### Data Import #####
-
-DATA_PATH = os.path.join(package_root._root, 'data')
-
-credit_card_data_path = os.path.join(DATA_PATH, 'credit_card_data.csv')
-credit_card_df = pd.read_csv(credit_card_data_path)
-credit_card_df['Date'] = pd.to_datetime(credit_card_df['Date'], format='%Y-%m-%d')
-
-bank_withdrawals_path = os.path.join(DATA_PATH, 'deductions.csv')
-bank_withdrawals_df = pd.read_csv(bank_withdrawals_path)
-bank_withdrawals_df['Date'] = pd.to_datetime(bank_withdrawals_df['Date'], format='%Y-%m-%d')
-
 ##### Helper Functions #####
 
 def total_assets_summary():
     '''
     Get the total value of all assets and add this value to an H4
     '''
-    total = get_total_assets()
+    total = to_dollars(get_total_assets())
 
     total_text = html.H4(
         f'TOTAL ASSETS: {round(total, 2)}',
@@ -52,9 +40,8 @@ def get_bank_summary(summary_type, n_months):
     month_txt = f'{n_months} Month' if n_months>0 else 'Monthly'
 
     # collect data
-    rent, credit, misc = get_spending(summary_type, n_months)
-    income = get_income(summary_type, n_months)
-    saved = get_totals(summary_type, n_months)
+    summary = get_summary(summary_type, n_months)
+    income, rent, credit, misc, saved = (to_dollars(summary[k]) for k in ['income', 'rent', 'credit', 'misc', 'saved'])
     color = 'green' if saved >= 0 else 'red'   # used to indicate positive savings
 
     summary_list = [
@@ -231,82 +218,135 @@ date_pickers = dbc.Form([
 
 ##### Main Layout #####
 
-app.layout = dbc.Container(
-    [
-        dbc.Row(
-            dbc.Col([
-                color_mode_switch,
-                html.Br(),
-                dbc.Button('Upload', color='primary', outline=True, id='upload'),
-                html.H2(
-                    'FINANCIAL TRACKER',
-                    className='text-center text-primary p-2',
-                ),
-                html.Div([
-                    total_assets_summary()
-                ],
-                id='total'),
-                html.Hr(),
-            ])
-        ),
-        dbc.Row(
-            [
-                dbc.Col(
-                    [
-                        dbc.Card([
-                            dbc.CardHeader('SPENDING'),
-                            dbc.CardBody(
-                                [
-                                    spend_inputs,
-                                    html.Br(),
-                                    html.Div(id='bank_summary'),
-                                    html.Br(),
-                                    date_pickers,
-                                    dcc.Graph(id='spend_pie_chart', className='mb-2'),
-                                    dcc.Graph(id="spend_line_chart", className="mb-2"),
-                                ]
+def serve_layout():
+    '''
+    Build the page layout. Dash calls this on every page load, so building it
+    reads no data, the totals and plots are filled in by the callbacks
+    '''
+    return dbc.Container(
+        [
+            dbc.Row(
+                dbc.Col([
+                    color_mode_switch,
+                    html.Br(),
+                    dbc.Button('Upload', color='primary', outline=True, id='upload'),
+                    html.Span(id='upload_status', className='ms-2'),
+                    dcc.Store(id='upload_job'),
+                    dcc.Interval(id='upload_poll', interval=1000, disabled=True),
+                    html.H2(
+                        'FINANCIAL TRACKER',
+                        className='text-center text-primary p-2',
+                    ),
+                    # filled in by display_total once the page has loaded
+                    html.Div(id='total'),
+                    html.Hr(),
+                ])
+            ),
+            dbc.Row(
+                [
+                    dbc.Col(
+                        [
+                            dbc.Card([
+                                dbc.CardHeader('SPENDING'),
+                                dbc.CardBody(
+                                    [
+                                        spend_inputs,
+                                        html.Br(),
+                                        html.Div(id='bank_summary'),
+                                        html.Br(),
+                                        date_pickers,
+                                        dcc.Graph(id='spend_pie_chart', className='mb-2'),
+                                        dcc.Graph(id="spend_line_chart", className="mb-2"),
+                                    ]
+                                ),
+                            ],
+                            style={'width': 'auto'},
                             ),
                         ],
-                        style={'width': 'auto'},
-                        ),
-                    ],
-                    className='pt-4',
-                ),
-                dbc.Col(
-                    [
-                        dbc.Card([
-                            dbc.CardHeader('INVESTMENTS'),
-                            dbc.CardBody(
-                                [
-                                    input_form,
-                                    dcc.Graph(id="investment_line_chart", className="mb-2"),
-                                ]
-                            ),
-                        ]),
-                    ],
-                    className="pt-4",
-                ),
-            ],
-            className="ms-1",
-        ),
-    ],
-    fluid=True,
-)
+                        className='pt-4',
+                    ),
+                    dbc.Col(
+                        [
+                            dbc.Card([
+                                dbc.CardHeader('INVESTMENTS'),
+                                dbc.CardBody(
+                                    [
+                                        input_form,
+                                        dcc.Graph(id="investment_line_chart", className="mb-2"),
+                                    ]
+                                ),
+                            ]),
+                        ],
+                        className="pt-4",
+                    ),
+                ],
+                className="ms-1",
+            ),
+        ],
+        fluid=True,
+    )
+
+
+app.layout = serve_layout
+
+
+def warm_up():
+    '''
+    Load the ledgers and the monthly rollup in the background so the first
+    callbacks find them in memory. Ledgers whose charts are answered by the
+    storage backend, or read a month at a time, are never held whole in
+    memory, so they aren't loaded
+    '''
+    for ledger in ['credit_card_data', 'deductions', 'investments']:
+        if ledger_exists(ledger) and not pushdown_stem(ledger) and not get_layout().partitioned:
+            ledger_store.get(ledger)
+    get_summary(True)
+    get_total_assets()
+
 
 ##### Callbacks #####
 
 @app.callback(
+        Output('upload_job', 'data'),
+        Output('upload_poll', 'disabled'),
         Input('upload', 'n_clicks'),
+        prevent_initial_call=True,
 )
 def upload_data(upload):
     '''
-    Upload bank and credit card data files when upload function is pressed
+    Start uploading the bank and credit card data files in the background
+    when the upload button is pressed, and start polling its progress
     '''
-    changed_id = [p['prop_id'] for p in callback_context.triggered][0]
-    if 'upload' in changed_id:
-        print('in here')
-        extract_credit_card_data()
-        extract_bank_data()
+    return start_ingestion(), False
+
+
+@app.callback(
+        Output('upload_status', 'children'),
+        Output('upload_poll', 'disabled', allow_duplicate=True),
+        Input('upload_poll', 'n_intervals'),
+        State('upload_job', 'data'),
+        prevent_initial_call=True,
+)
+def display_upload_progress(n_intervals, job_id):
+    '''
+    Show the progress of the running upload, and stop polling once it has
+    finished
+    '''
+    job = job_progress(job_id)
+    if job is None:
+        return '', True
+
+    if job['status'] == 'queued':
+        return 'Upload queued', False
+    if job['status'] == 'running':
+        current = f" ({job['file']})" if job['file'] else ''
+        return f"Uploading {job['done']}/{job['total']} files{current}", False
+    if job['status'] == 'failed':
+        return f"Upload failed: {job['error']}", True
+
+    uploaded = job['done'] - len(job['skipped'])
+    skipped = f", skipped {'; '.join(job['skipped'])}" if job['skipped'] else ''
+    return f"Uploaded {uploaded} files{skipped}, press REFRESH to update", True
 
 
 @app.callback(
@@ -361,7 +401,7 @@ def display_monthly_data(summary_type, n_months, refresh, submit):
     State('dow', 'value'),
     State('nasdaq', 'value'),
     State('snp', 'value'),
-    Input('switch', 'value'),
+    State('switch', 'value'),
     Input('submit_investments', 'n_clicks'),
 )
 def update_data_display(etrade, retirement, leidos, cambridge, dow, nasdaq, snp, switch, n_clicks):
@@ -375,13 +415,13 @@ def update_data_display(etrade, retirement, leidos, cambridge, dow, nasdaq, snp,
             'cambridge': cambridge, 'nasdaq': nasdaq, 'dow': dow, 'snp': snp}
     if etrade or retirement or leidos or cambridge or nasdaq or dow or snp:
         update_investment_data(data)
-    path = os.path.join(DATA_PATH, 'investments.csv')
-
-    if n_clicks or os.path.exists(path):
-        df = pd.read_csv(path)
-        line_figure = line_chart(df,
-                                credit=False,
-                                switch=switch)
+    if ledger_exists('investments'):
+        # investments are balances, plot the last one of each period
+        line_figure = ledger_line_chart('investments',
+                                        credit=False,
+                                        switch=switch,
+                                        version=ledger_version('investments'),
+                                        agg='last')
         
         return line_figure, {}, '', '', '', '', '', '', ''
     else:
@@ -395,7 +435,7 @@ def update_data_display(etrade, retirement, leidos, cambridge, dow, nasdaq, snp,
     Output('spend_line_chart', 'style'),
     Input('submit_date', 'n_clicks'),
     Input('refresh', 'n_clicks'),
-    Input('switch', 'value'),
+    State('switch', 'value'),
     Input('data_switch', 'value'),
     State('start_date', 'date'),
     State('end_date', 'date'),
@@ -405,35 +445,103 @@ def update_data_display(etrade, retirement, leidos, cambridge, dow, nasdaq, snp,
 def update_pie(n_clicks, refresh, switch, data_switch, start_date, end_date, year, month):
     '''
     Display the bank or credit card summary plots based on input dates and
-    update the plots based on the color mode selected or if the refresh button
-    was selected.  
+    update the plots if the refresh button was selected. The plots are drawn
+    in the color mode currently selected, and stay hidden until data has been
+    uploaded
     '''
-    if n_clicks:
-        if data_switch:
-            df = credit_card_df
-            credit = True
-        else:
-            df = bank_withdrawals_df
-            credit = False
+    ledger = 'credit_card_data' if data_switch else 'deductions'
+    if n_clicks and ledger_exists(ledger):
+        credit = bool(data_switch)
+
+        # the category totals and line series are computed by the storage
+        # backend, and the figures are cached per ledger version so they are
+        # only rebuilt once new data has been written
+        version = ledger_version(ledger)
         
-        pie_figure = pie_chart(df,
-                               start_date,
-                               end_date,
-                               year,
-                               month,
-                               switch,
-                               credit
-                               )
+        pie_figure = ledger_pie_chart(ledger,
+                                      start_date,
+                                      end_date,
+                                      year,
+                                      month,
+                                      switch,
+                                      credit,
+                                      version=version,
+                                      )
         
-        line_figure = line_chart(df,
-                                 credit,
-                                 switch)
+        line_figure = ledger_line_chart(ledger,
+                                        credit,
+                                        switch,
+                                        version=version)
 
         return pie_figure, {}, line_figure, {}
     else:
         return None, {'display': 'none'}, None, {'display': 'none'}
        
 
+def zoomed_line_chart(ledger, relayout, style, switch, credit, agg='sum'):
+    '''
+    Redraw a displayed line chart for the range it was zoomed or panned to,
+    aggregated by the frequency the visible span calls for. Resetting the
+    zoom draws the whole ledger again
+    '''
+    window = zoomed_range(relayout)
+    if window is None or style is None or style.get('display') == 'none' or not ledger_exists(ledger):
+        return no_update
+
+    return ledger_line_chart(ledger,
+                             credit,
+                             switch,
+                             version=ledger_version(ledger),
+                             agg=agg,
+                             start=window[0],
+                             end=window[1])
+
+
+@app.callback(
+    Output('spend_line_chart', 'figure', allow_duplicate=True),
+    Input('spend_line_chart', 'relayoutData'),
+    State('spend_line_chart', 'style'),
+    State('switch', 'value'),
+    State('data_switch', 'value'),
+    prevent_initial_call=True,
+)
+def zoom_spend_line(relayout, style, switch, data_switch):
+    ledger = 'credit_card_data' if data_switch else 'deductions'
+    return zoomed_line_chart(ledger, relayout, style, switch, bool(data_switch))
+
+
+@app.callback(
+    Output('investment_line_chart', 'figure', allow_duplicate=True),
+    Input('investment_line_chart', 'relayoutData'),
+    State('investment_line_chart', 'style'),
+    State('switch', 'value'),
+    prevent_initial_call=True,
+)
+def zoom_investment_line(relayout, style, switch):
+    return zoomed_line_chart('investments', relayout, style, switch, credit=False, agg='last')
+
+
+@app.callback(
+    Output('spend_pie_chart', 'figure', allow_duplicate=True),
+    Output('spend_line_chart', 'figure', allow_duplicate=True),
+    Output('investment_line_chart', 'figure', allow_duplicate=True),
+    Input('switch', 'value'),
+    State('spend_pie_chart', 'style'),
+    State('spend_line_chart', 'style'),
+    State('investment_line_chart', 'style'),
+    prevent_initial_call=True,
+)
+def update_theme(switch, pie_style, line_style, investment_style):
+    '''
+    Change the colors of the displayed plots when the color mode is switched.
+    Only the layout colors are sent, the plots aren't rebuilt and hidden plots
+    are left alone
+    '''
+    styles = [pie_style, line_style, investment_style]
+
+    return tuple(no_update if style is None or style.get('display') == 'none' else theme_patch(switch) for style in styles)
+
+
 clientside_callback(
     """
     (switchOn) => {
@@ -447,4 +555,5 @@ clientside_callback(
 
 
 if __name__ == "__main__":
+    threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
     app.run(debug=True)
@@ -0,0 +1,157 @@
+import os
+import re
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from src.storage import write_json_atomic, data_path
+
+
+# ordered pattern -> category rules for each data source, the first rule whose
+# pattern matches a transaction description sets its category
+RULES_PATH = os.environ.get('FINANCE_TRACKER_RULES',
+                            os.path.join(os.path.dirname(__file__), 'category_rules.json'))
+
+# compiled matchers keyed on source, along with the rules file modification
+# time they were built from
+_matchers = {}
+_matchers_lock = threading.Lock()
+
+# persistent description -> category cache for each source, only descriptions
+# that have not been seen before are run through the matcher. The entries are
+# kept in least recently used order and dropped once a source has more than
+# CACHE_SIZE of them
+CACHE_FILE = 'category_cache.json'
+CACHE_SIZE = 50000
+_description_cache = None
+_description_lock = threading.Lock()
+
+
+def compile_rules(rules, ignore_case=True):
+    '''
+    Combine the ordered rules into a single regex. Every rule becomes a
+    lookahead alternative followed by an empty named group, alternatives are
+    tried in order at the start of the description so the first rule that
+    matches anywhere in it is the one whose group is set
+    '''
+    alternatives = [f'(?=.*?(?:{rule["pattern"]}))(?P<rule{idx}>)' for idx, rule in enumerate(rules)]
+    flags = re.DOTALL | (re.IGNORECASE if ignore_case else 0)
+
+    return re.compile('^(?:' + '|'.join(alternatives) + ')', flags)
+
+
+def get_matcher(source):
+    '''
+    Return the compiled matcher, the rule categories, and a hash of the rules
+    for a data source, rebuilding them when the rules file changes
+    '''
+    mtime = os.stat(RULES_PATH).st_mtime_ns
+
+    with _matchers_lock:
+        cached = _matchers.get(source)
+        if cached and cached[0] == (RULES_PATH, mtime):
+            return cached[1]
+
+        with open(RULES_PATH) as f:
+            config = json.load(f)
+
+        if source not in config:
+            raise ValueError(f'No category rules for {source} in {RULES_PATH}')
+
+        rules = config[source]['rules']
+        matcher = compile_rules(rules, config[source].get('ignore_case', True)) if rules else None
+        categories = np.array([rule['category'] for rule in rules], dtype=object)
+        version = hashlib.sha256(json.dumps(config[source], sort_keys=True).encode()).hexdigest()
+
+        _matchers[source] = ((RULES_PATH, mtime), (matcher, categories, version))
+
+    return matcher, categories, version
+
+
+def match_descriptions(descriptions: pd.Series, source: str):
+    '''
+    Assign a category to every description in one pass over the column.
+    Descriptions that don't match any rule are returned as NaN
+    '''
+    matcher, categories, _ = get_matcher(source)
+    if matcher is None or descriptions.empty:
+        return pd.Series(np.nan, index=descriptions.index, dtype=object)
+
+    groups = [f'rule{idx}' for idx in range(len(categories))]
+    matched = descriptions.astype('string').str.extract(matcher)[groups].notna().to_numpy()
+
+    # the matcher sets at most one group per description, the first rule
+    # that matched
+    hit = matched.any(axis=1)
+    first = matched.argmax(axis=1)
+
+    return pd.Series(np.where(hit, categories[first], np.nan), index=descriptions.index, dtype=object)
+
+
+##### Description cache #####
+
+def _load_description_cache():
+    global _description_cache
+
+    if _description_cache is None:
+        _description_cache = {}
+        if os.path.exists(data_path(CACHE_FILE)):
+            with open(data_path(CACHE_FILE)) as f:
+                stored = json.load(f)
+            for source, cache in stored.items():
+                _description_cache[source] = (cache['rules'], OrderedDict(cache['entries']))
+
+    return _description_cache
+
+
+def _save_description_cache():
+    stored = {
+        source: {'rules': version, 'entries': list(entries.items())}
+        for source, (version, entries) in _description_cache.items()
+    }
+    write_json_atomic(data_path(CACHE_FILE), stored)
+
+
+def categorize(descriptions: pd.Series, source: str):
+    '''
+    Assign a category to every description. Only unique descriptions that are
+    not in the description cache are matched against the rules, the rest are
+    mapped with a dictionary lookup. Descriptions that don't match any rule
+    are returned as NaN so callers can keep the category the data source
+    provided
+    '''
+    _, _, version = get_matcher(source)
+    uniques = descriptions.dropna().unique()
+
+    with _description_lock:
+        cache = _load_description_cache()
+
+        # the cached categories are only valid for the rules they came from
+        if source not in cache or cache[source][0] != version:
+            cache[source] = (version, OrderedDict())
+        entries = cache[source][1]
+
+        lookup = {}
+        unseen = []
+        for description in uniques:
+            if description in entries:
+                entries.move_to_end(description)
+                lookup[description] = entries[description]
+            else:
+                unseen.append(description)
+
+        if unseen:
+            matched = match_descriptions(pd.Series(unseen, dtype=object), source)
+            for description, category in zip(unseen, matched):
+                lookup[description] = entries[description] = category if isinstance(category, str) else None
+
+            while len(entries) > CACHE_SIZE:
+                entries.popitem(last=False)
+
+            _save_description_cache()
+
+    return descriptions.map(lookup).astype(object)
@@ -0,0 +1,92 @@
+import os
+import glob
+import uuid
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from src.plotting import clear_figure_cache
+from src.storage import data_path
+import src.utils as utils
+
+
+##### Background ingestion #####
+# uploads run on a single background thread so they never block a Dash worker
+# and two uploads never ingest the same files at once. Every job keeps its
+# progress in _jobs so the app can poll it
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ingest')
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+
+def pending_files():
+    '''
+    Return the source files waiting to be ingested
+    '''
+    files = []
+    for directory, pattern in [('credit_card_data', '*.csv'), ('bank_data', '*.pdf'), ('bank_data', '*.csv')]:
+        files += sorted(glob.glob(data_path(directory, pattern)))
+
+    return files
+
+
+def _update_job(job_id, **changes):
+    with _jobs_lock:
+        _jobs[job_id].update(changes)
+
+
+def _file_done(job_id, path, skipped=None):
+    with _jobs_lock:
+        job = _jobs[job_id]
+        job['done'] += 1
+        job['file'] = os.path.basename(path)
+        if skipped:
+            job['skipped'].append(f'{os.path.basename(path)} ({skipped})')
+
+
+def run_ingestion(job_id):
+    '''
+    Ingest every pending credit card and bank file, reporting each file as it
+    is read or skipped. The ledger store picks up the written rows as they go
+    in, the cached figures are dropped once the job ends
+    '''
+    _update_job(job_id, status='running', total=len(pending_files()))
+    progress = lambda path, skipped=None: _file_done(job_id, path, skipped)
+
+    try:
+        utils.extract_credit_card_data(progress=progress)
+        utils.extract_bank_data(progress=progress)
+    except Exception as error:
+        traceback.print_exc()
+        _update_job(job_id, status='failed', error=str(error))
+    else:
+        _update_job(job_id, status='done')
+    finally:
+        clear_figure_cache()
+
+
+def start_ingestion():
+    '''
+    Queue an ingestion job and return its id. While a job is still queued or
+    running its id is returned instead of queueing another
+    '''
+    with _jobs_lock:
+        for job_id, job in _jobs.items():
+            if job['status'] in ('queued', 'running'):
+                return job_id
+
+        job_id = uuid.uuid4().hex
+        _jobs[job_id] = {'status': 'queued', 'done': 0, 'total': 0, 'file': None, 'error': None, 'skipped': []}
+
+    _executor.submit(run_ingestion, job_id)
+
+    return job_id
+
+
+def job_progress(job_id):
+    '''
+    Return a copy of the progress of a job, or None for an unknown job
+    '''
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        return dict(job, skipped=list(job['skipped'])) if job else None
@@ -1,62 +1,244 @@
+import threading
+from collections import OrderedDict
+from datetime import date
+
+import numpy as np
 import pandas as pd
+from dash import Patch
 import plotly.graph_objects as go
-import plotly.express as px
 
 import package_root
-from src.utils import date_parser
+from src.utils import date_window, aggregate_ledger, ledger_date_span
+from src.storage import to_dollars
+
+
+# figures built for a ledger, keyed on the chart, the ledger version and the
+# chart inputs and kept in least recently used order. The theme isn't part of
+# the key, it is applied to a copy of the cached figure
+FIGURE_CACHE_SIZE = 32
+_figures = OrderedDict()
+_figures_lock = threading.Lock()
+
+# line charts aggregate each category by day, week, or month depending on the
+# span of the data, and longer series are downsampled to at most
+# LINE_CHART_POINTS points per category
+LINE_CHART_FREQUENCIES = [(pd.Timedelta(days=730), 'D', 'Daily'), (pd.Timedelta(days=3650), 'W', 'Weekly')]
+LINE_CHART_POINTS = 500
+
+
+def cached_figure(key, build):
+    '''
+    Return the cached figure for the key, building and caching it if it
+    isn't cached yet
+    '''
+    with _figures_lock:
+        if key in _figures:
+            _figures.move_to_end(key)
+            return _figures[key]
+
+    fig = build()
+
+    with _figures_lock:
+        _figures[key] = fig
+        while len(_figures) > FIGURE_CACHE_SIZE:
+            _figures.popitem(last=False)
+
+    return fig
 
 
-def line_chart(data: pd.DataFrame, credit: bool = True, switch: bool = True):
+def clear_figure_cache():
     '''
-    Plot the line chart for the given data
+    Drop every cached figure
     '''
-    y = 'Debit' if credit else 'Amount'   # dynamically change title text
+    with _figures_lock:
+        _figures.clear()
 
-    fig = px.line(data, x='Date', y=y, color='Category')
 
-    # change background and text color based on selected light or dark mode
+def theme_colors(switch: bool = True):
+    '''
+    Return the background and text color of the selected light or dark mode
+    '''
     if switch:
-        background = 'white'
-        font = '#1C2525'
-    else:
-        background = '#1C2525'
-        font = 'white'
+        return 'white', '#1C2525'
+
+    return '#1C2525', 'white'
+
+
+def theme_patch(switch: bool = True):
+    '''
+    Return a partial figure update that only changes the layout colors to
+    the selected light or dark mode
+    '''
+    background, font = theme_colors(switch)
+
+    patch = Patch()
+    patch['layout']['paper_bgcolor'] = background
+    patch['layout']['font']['color'] = font
+
+    return patch
+
 
-    title = f"Overall {'Credit' if credit else 'Account'} Spend Summary "
+def apply_theme(fig: go.Figure, switch: bool = True):
+    '''
+    Return a copy of the figure with the colors of the selected light or dark
+    mode
+    '''
+    background, font = theme_colors(switch)
+
+    fig = go.Figure(fig)
+    fig.update_layout(
+        paper_bgcolor=background,
+        font=dict(color=font),
+    )
+
+    return fig
+
+
+def line_frequency(first, last):
+    '''
+    Pick the frequency to aggregate a line chart by from the span of its dates
+    '''
+    span = last - first
+    if pd.isna(span):
+        span = pd.Timedelta(0)
+    for longest, freq, name in LINE_CHART_FREQUENCIES:
+        if span <= longest:
+            return freq, name
+
+    return 'ME', 'Monthly'
+
+
+def line_window(start, end, freq):
+    '''
+    Widen a range to whole periods of freq, so the first and last points of
+    a zoomed line chart aren't sums over part of a period
+    '''
+    period = 'M' if freq == 'ME' else freq
+
+    return pd.Timestamp(start).to_period(period).start_time, pd.Timestamp(end).to_period(period).end_time
+
+
+def zoomed_range(relayout):
+    '''
+    Return the x range a line chart was zoomed or panned to from its
+    relayoutData, (None, None) when it was reset to show everything, or None
+    when the x range didn't change
+    '''
+    if not relayout:
+        return None
+    if relayout.get('xaxis.autorange'):
+        return None, None
+    if 'xaxis.range[0]' in relayout and 'xaxis.range[1]' in relayout:
+        return relayout['xaxis.range[0]'], relayout['xaxis.range[1]']
+    if 'xaxis.range' in relayout:
+        return tuple(relayout['xaxis.range'])
+
+    return None
+
+
+def lttb(x: np.ndarray, y: np.ndarray, n_out: int):
+    '''
+    Return the indices of n_out points of the series chosen with largest
+    triangle three buckets, which keeps the peaks and troughs that shape the
+    line. The first and last points are always kept
+    '''
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    # split the points between the first and last into n_out - 2 buckets, the
+    # last point is a bucket of its own
+    edges = np.append(np.linspace(1, n - 1, n_out - 1).astype(int), n)
+
+    keep = [0]
+    for idx in range(n_out - 2):
+        start, end = edges[idx], edges[idx + 1]
+        next_start, next_end = edges[idx + 1], edges[idx + 2]
+        next_x, next_y = x[next_start:next_end].mean(), y[next_start:next_end].mean()
+
+        # keep the point making the largest triangle with the last kept point
+        # and the average of the next bucket
+        prev = keep[-1]
+        area = np.abs((x[prev] - next_x) * (y[start:end] - y[prev]) - (x[prev] - x[start:end]) * (next_y - y[prev]))
+        keep.append(start + int(np.argmax(area)))
+    keep.append(n - 1)
+
+    return np.array(keep)
+
+
+def downsample_series(series: pd.DataFrame, y: str, n_points: int = LINE_CHART_POINTS):
+    '''
+    Downsample the aggregated series of categories with more than n_points
+    points
+    '''
+    frames = []
+    for _, group in series.groupby('Category', observed=True, sort=False):
+        if len(group) > n_points:
+            x = group['Date'].to_numpy(dtype='datetime64[ns]').astype('int64').astype(float)
+            group = group.iloc[lttb(x, group[y].to_numpy(dtype=float), n_points)]
+        frames.append(group)
+
+    return pd.concat(frames, ignore_index=True) if frames else series
+
+
+def line_figure(series: pd.DataFrame, y: str, freq_name: str, credit: bool = True):
+    '''
+    Draw the line chart of the aggregated series
+    '''
+    import plotly.express as px   # only loaded once a line chart is drawn
+
+    # the ledgers hold cents, plot dollars
+    fig = px.line(series.assign(**{y: to_dollars(series[y])}), x='Date', y=y, color='Category')
+
+    title = f"Overall {'Credit' if credit else 'Account'} Spend Summary ({freq_name})"
     fig.update_layout(
         title_text=title,
         title_x=0.5,
         margin=dict(b=25, t=75, l=35, r=25),
         height=325,
-        paper_bgcolor=background,
-        font=dict(color=font),
     )
 
     return fig
 
 
-def pie_chart(data: pd.DataFrame, 
-              start_date: str = None, 
-              end_date: str = None, 
-              year: int = None, 
-              month: int = None,
-              switch: bool = True,
-              credit: bool = True):
+def ledger_line_chart(ledger: str, credit: bool = True, switch: bool = True, version=None, agg: str = 'sum',
+                      start=None, end=None):
     '''
-    Plot the pie graph for the selected data source based on the selected dates
+    Plot the line chart for a stored ledger, aggregated per category by day,
+    week, or month depending on the span of the dates shown. The aggregation
+    is done by the storage backend. Transactions are summed, use agg='last'
+    for balances. When start and end are given only that range is shown,
+    otherwise the whole ledger. When the version of the ledger is given the
+    figure is cached
     '''
+    def build():
+        y = 'Debit' if credit else 'Amount'   # dynamically change title text
+        if start is not None and end is not None:
+            freq, freq_name = line_frequency(pd.Timestamp(start), pd.Timestamp(end))
+            first, last = line_window(start, end, freq)
+            series = aggregate_ledger(ledger, y, start=first, end=last, freq=freq, agg=agg)
+        else:
+            freq, freq_name = line_frequency(*ledger_date_span(ledger))
+            series = aggregate_ledger(ledger, y, freq=freq, agg=agg)
+
+        fig = line_figure(downsample_series(series, y), y, freq_name, credit)
+        if start is not None and end is not None:
+            fig.update_xaxes(range=[start, end])
+
+        return fig
+
+    key = ('line', version, ledger, credit, agg, start, end)
+    fig = cached_figure(key, build) if version is not None else build()
 
-    # get only a subset of the data based on the selected dates
-    subset, date_string = date_parser(data,
-                                      start_date,
-                                      end_date,
-                                      year,
-                                      month)
+    return apply_theme(fig, switch)
 
-    labels = subset['Category'].unique().tolist()
-    col_name = 'Debit' if credit else 'Amount'
-    group = subset.groupby(['Category'])[col_name].sum()
-    values = group.values.tolist()
+
+def pie_figure(group: pd.Series, date_string: str, credit: bool = True):
+    '''
+    Draw the pie graph of the category totals in group
+    '''
+    labels = group.index.tolist()
+    values = to_dollars(group).tolist()
 
     fig = go.Figure(
         data=[
@@ -69,14 +251,6 @@ def pie_chart(data: pd.DataFrame,
                 hoverinfo='none',
             )
         ])
-    
-    # change background and text color based on selected light or dark mode
-    if switch:
-        background = 'white'
-        font = '#1C2525'
-    else:
-        background = '#1C2525'
-        font = 'white'
 
     # Dynamically change title based on data source
     title = f"{'Credit' if credit else 'Account'} Summary for {date_string}"
@@ -86,8 +260,34 @@ def pie_chart(data: pd.DataFrame,
         title_x=0.5,
         margin=dict(b=25, t=75, l=35, r=25),
         height=325,
-        paper_bgcolor=background,
-        font=dict(color=font),
     )
 
-    return fig
\ No newline at end of file
+    return fig
+
+
+def ledger_pie_chart(ledger: str,
+                     start_date: str = None,
+                     end_date: str = None,
+                     year: int = None,
+                     month: int = None,
+                     switch: bool = True,
+                     credit: bool = True,
+                     version=None):
+    '''
+    Plot the pie graph for a stored ledger based on the selected dates, with
+    the category totals computed by the storage backend. When the version of
+    the ledger is given the figure is cached
+    '''
+    def build():
+        start, end, end_inclusive, date_string = date_window(start_date, end_date, year, month)
+
+        col_name = 'Debit' if credit else 'Amount'
+        totals = aggregate_ledger(ledger, col_name, start=start, end=end, end_inclusive=end_inclusive)
+
+        return pie_figure(totals.set_index('Category')[col_name], date_string, credit)
+
+    # without any dates the current month is shown, so the day is part of the key
+    key = ('pie', version, ledger, start_date, end_date, year, month, credit, date.today())
+    fig = cached_figure(key, build) if version is not None else build()
+
+    return apply_theme(fig, switch)
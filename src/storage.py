@@ -0,0 +1,1056 @@
+import os
+import re
+import sys
+import json
+import time
+import sqlite3
+import itertools
+import threading
+from contextlib import closing
+
+import numpy as np
+import pandas as pd
+
+import package_root
+
+
+DATA_PATH = os.path.join(package_root._root, 'data')
+
+
+def data_path(*parts):
+    '''
+    Return a path inside the data directory. DATA_PATH is looked up on every
+    call, so pointing it elsewhere moves every ledger, index and cache
+    '''
+    return os.path.join(DATA_PATH, *parts)
+
+# ledgers kept in the data directory
+LEDGERS = ['credit_card_data', 'deductions', 'additions', 'totals', 'investments']
+
+# storage format used for the ledgers, either 'csv', 'parquet', or 'sqlite'
+STORAGE_BACKEND = os.environ.get('FINANCE_TRACKER_STORAGE', 'csv')
+
+# how ledgers are laid out in the data directory, either 'flat' for one
+# ledger per file or 'monthly' for one partition per year and month
+STORAGE_LAYOUT = os.environ.get('FINANCE_TRACKER_LAYOUT', 'flat')
+
+# categories each ledger is known to hold. Transaction ledgers take theirs
+# from the category rules of their sources, plus Misc for bank transactions
+# no rule matched
+CATEGORY_SOURCES = {
+    'deductions': ['bank'],
+    'additions': ['bank'],
+    'credit_card_data': ['credit_card'],
+    'monthly_rollup': ['bank', 'credit_card'],
+}
+INVESTMENT_CATEGORIES = ['etrade', 'retirement', 'leidos', 'cambridge', 'dow', 'nasdaq', 'snp']
+
+# columns holding money. In memory they are int64 cents so sums are exact,
+# CSV ledgers keep them in dollars so the files stay readable
+MONEY_COLUMNS = ['Amount', 'Debit', 'Total', 'Added', 'Lost']
+
+
+##### Money #####
+
+def to_cents(values):
+    '''
+    Convert dollar amounts to int64 cents, or nullable Int64 cents when some
+    amounts are missing
+    '''
+    values = pd.Series(values)
+    cents = np.rint(pd.to_numeric(values).to_numpy(dtype=float) * 100)
+    if np.isnan(cents).any():
+        return pd.Series(cents, index=values.index).astype('Int64')
+
+    return pd.Series(cents.astype('int64'), index=values.index)
+
+
+def to_dollars(values):
+    '''
+    Convert cents to dollars for display
+    '''
+    return values / 100
+
+
+##### JSON files #####
+
+def write_json_atomic(path, obj):
+    '''
+    Write obj to path as JSON. It goes to a temporary file that is renamed
+    into place, so a crash can't leave a partially written file behind
+    '''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp_path, path)
+
+
+##### Append only ledger writes #####
+
+def complete_length(f):
+    '''
+    Return the length of the open file up to and including its last newline.
+    Anything after it is a row torn by a crash part way through an append
+    '''
+    position = f.seek(0, os.SEEK_END)
+    while position > 0:
+        step = min(4096, position)
+        f.seek(position - step)
+        newline = f.read(step).rfind(b'\n')
+        if newline >= 0:
+            return position - step + newline + 1
+        position -= step
+
+    return 0
+
+
+def append_csv(path, df):
+    '''
+    Append the rows of df to the CSV at path without reading back the rows
+    that are already stored. A new file is written to a temporary file and
+    renamed into place. For an existing file only the header is read to check
+    the schema, and if the append fails part way the file is cut back to its
+    original length so the existing history is never lost. A row torn by an
+    earlier crash is cut off before appending. Nothing is written for an
+    empty df
+    '''
+    if df.empty:
+        return
+
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.tmp'
+        df.to_csv(tmp_path, index=False, date_format='%Y-%m-%d')
+        os.replace(tmp_path, path)
+        return
+
+    # the new rows must carry the same columns as the file, reorder them to
+    # match the stored header if needed
+    columns = pd.read_csv(path, nrows=0).columns.tolist()
+    if sorted(columns) != sorted(df.columns):
+        raise ValueError(f'Columns {df.columns.tolist()} do not match {columns} in {path}')
+
+    # render the rows before the file is touched so a formatting error can't
+    # leave a partial write behind
+    rows = df[columns].to_csv(header=False, index=False, date_format='%Y-%m-%d')
+
+    with open(path, 'rb+') as f:
+        size = f.seek(0, os.SEEK_END)
+        complete = complete_length(f)
+        if complete < size:
+            f.truncate(complete)
+            os.fsync(f.fileno())
+        size = f.seek(complete)
+
+        try:
+            f.write(rows.encode())
+            f.flush()
+            os.fsync(f.fileno())
+        except BaseException:
+            f.truncate(size)
+            raise
+
+
+##### Storage backends #####
+# backends store a piece of a ledger under a path stem, the layout decides
+# which stems make up a ledger
+
+class CsvBackend:
+    '''
+    Store ledger data as CSV files, e.g. deductions.csv
+    '''
+    name = 'csv'
+    extension = '.csv'
+    layouts = ('flat', 'monthly')
+
+    def path(self, stem):
+        return f'{stem}{self.extension}'
+
+    def exists(self, stem):
+        return os.path.exists(self.path(stem))
+
+    def signature(self, stem):
+        stat = os.stat(self.path(stem))
+        return stat.st_mtime_ns, stat.st_size
+
+    def columns(self, stem):
+        return pd.read_csv(self.path(stem), nrows=0).columns.tolist()
+
+    def read(self, stem, columns=None):
+        df = pd.read_csv(self.path(stem), usecols=columns)
+
+        # leave out a row torn by a crash part way through an append, the
+        # next append cuts it off the file
+        with open(self.path(stem), 'rb') as f:
+            if complete_length(f) < f.seek(0, os.SEEK_END):
+                df = df.iloc[:-1]
+
+        if 'Date' in df.columns:
+            df['Date'] = pd.to_datetime(df['Date'], format='%Y-%m-%d')
+        for column in df.columns.intersection(MONEY_COLUMNS):
+            df[column] = to_cents(df[column])
+
+        return df
+
+    def append(self, stem, df):
+        money = df.columns.intersection(MONEY_COLUMNS)
+        append_csv(self.path(stem), df.assign(**{column: to_dollars(df[column]) for column in money}))
+
+
+# parquet ledgers merge their part files into a single base file once they
+# have more than PARQUET_PARTS of them
+PARQUET_PARTS = int(os.environ.get('FINANCE_TRACKER_PARQUET_PARTS', 32))
+
+
+class ParquetBackend:
+    '''
+    Store ledger data as directories of Parquet part files, e.g.
+    deductions.parquet/part-<time>.parquet. Date is kept as a native timestamp,
+    money as int64 cents and Category is dictionary encoded, so reads skip the
+    CSV parsing and only decode the requested columns. Every append writes a
+    new part file so the stored history is never rewritten on a write.
+
+    Once there are more than PARQUET_PARTS parts they are merged into a base
+    file, base-<time>.parquet, holding every part up to the time in its name.
+    Readers use the newest base and the parts written after it, so the parts
+    it replaced are ignored from the moment it is in place until they are
+    removed
+    '''
+    name = 'parquet'
+    extension = '.parquet'
+    layouts = ('flat', 'monthly')
+
+    def __init__(self):
+        # whether each part file holds float dollars, written before money
+        # was stored as cents. Parts are never changed once written
+        self._dollars = {}
+        self._lock = threading.RLock()
+
+    def path(self, stem):
+        return f'{stem}{self.extension}'
+
+    def parts(self, stem):
+        '''
+        Return the newest base file followed by the parts written after it,
+        oldest first
+        '''
+        path = self.path(stem)
+        try:
+            names = sorted(name for name in os.listdir(path) if name.endswith('.parquet'))
+        except FileNotFoundError:
+            return []
+
+        # base and part names both carry a 20 digit time after the prefix
+        bases = [name for name in names if name.startswith('base-')]
+        parts = [name for name in names if name.startswith('part-')]
+        if bases:
+            parts = bases[-1:] + [name for name in parts if name[5:25] > bases[-1][5:25]]
+
+        return [os.path.join(path, name) for name in parts]
+
+    def exists(self, stem):
+        return len(self.parts(stem)) > 0
+
+    def signature(self, stem):
+        # adding a part file changes the directory mtime and the parts
+        stat = os.stat(self.path(stem))
+        return stat.st_mtime_ns, tuple(os.path.basename(part) for part in self.parts(stem))
+
+    def columns(self, stem):
+        import pyarrow.parquet as pq
+        return pq.read_schema(self.parts(stem)[0]).names
+
+    def dollar_parts(self, parts):
+        '''
+        Return the parts written before money was stored as cents, which
+        hold float dollars
+        '''
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        for part in parts:
+            if part not in self._dollars:
+                schema = pq.read_schema(part)
+                self._dollars[part] = any(pa.types.is_floating(field.type) for field in schema if field.name in MONEY_COLUMNS)
+
+        return [part for part in parts if self._dollars[part]]
+
+    def read(self, stem, columns=None):
+        # a merge can remove the listed parts while they are read, they are
+        # then in the new base so the parts are listed again
+        while True:
+            parts = self.parts(stem)
+            if not parts:
+                raise FileNotFoundError(self.path(stem))
+            try:
+                return self.read_parts(parts, columns)
+            except FileNotFoundError:
+                if self.parts(stem) == parts:
+                    raise
+
+    def read_parts(self, parts, columns=None):
+        # dollar and cent parts can't be read as one table, and the dollar
+        # parts are the older ones so they come first
+        dollar_parts = self.dollar_parts(parts)
+        frames = [pd.read_parquet(part, columns=columns) for part in dollar_parts]
+        for df in frames:
+            for column in df.columns.intersection(MONEY_COLUMNS):
+                df[column] = to_cents(df[column])
+        if len(dollar_parts) < len(parts):
+            frames.append(pd.read_parquet([part for part in parts if part not in dollar_parts], columns=columns))
+
+        return frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True)
+
+    def write_part(self, path, name, df):
+        df = df.copy()
+        if 'Category' in df.columns:
+            df['Category'] = df['Category'].astype('category')
+
+        # write to a temporary file and rename it so readers never see a
+        # partial part file
+        part = os.path.join(path, name)
+        tmp_part = os.path.join(path, f'.{name}.tmp')
+        df.to_parquet(tmp_part, index=False)
+        os.replace(tmp_part, part)
+
+    def compact(self, stem):
+        '''
+        Merge the parts of the stem into a new base file, then remove them
+        '''
+        with self._lock:
+            parts = self.parts(stem)
+            if len(parts) < 2:
+                return
+
+            newest = os.path.basename(parts[-1])[5:25]
+            self.write_part(self.path(stem), f'base-{newest}.parquet', self.read_parts(parts))
+            for part in parts:
+                os.remove(part)
+                self._dollars.pop(part, None)
+
+    def append(self, stem, df):
+        if df.empty:
+            return
+
+        path = self.path(stem)
+        os.makedirs(path, exist_ok=True)
+
+        with self._lock:
+            # the new part must carry the same columns as the existing parts,
+            # and a time after theirs even if the clock went back, otherwise
+            # the base would hide it
+            stamp = time.time_ns()
+            parts = self.parts(stem)
+            if parts:
+                columns = self.columns(stem)
+                if sorted(columns) != sorted(df.columns):
+                    raise ValueError(f'Columns {df.columns.tolist()} do not match {columns} in {path}')
+                df = df[columns]
+                stamp = max(stamp, int(os.path.basename(parts[-1])[5:25]) + 1)
+
+            self.write_part(path, f'part-{stamp:020d}.parquet', df)
+            if len(self.parts(stem)) > PARQUET_PARTS:
+                self.compact(stem)
+
+
+class SqliteBackend:
+    '''
+    Store ledger data as tables of a single SQLite database, ledgers.sqlite,
+    with Date as ISO text and money as integer cents. Tables holding Date are
+    indexed on (Date) and on (Category, Date), so date windows and per
+    category aggregates are answered by the database and only their results
+    come back into Python. Every append is a single transaction that also
+    bumps the version of its table in _ledger_versions. Every table lives in
+    the one database, so only the flat layout is supported
+    '''
+    name = 'sqlite'
+    extension = '.sqlite'
+    layouts = ('flat',)
+
+    # SQL expressions labelling each row with its period, matching the
+    # labels of pd.Grouper for the same frequency
+    PERIODS = {
+        'D': 'Date',
+        'W': "date(Date, 'weekday 0')",
+        'ME': "date(Date, 'start of month', '+1 month', '-1 day')",
+    }
+
+    def path(self, stem):
+        return os.path.join(DATA_PATH, f'ledgers{self.extension}')
+
+    def table(self, stem):
+        return os.path.relpath(stem, DATA_PATH).replace(os.sep, '_')
+
+    def connect(self, stem):
+        con = sqlite3.connect(self.path(stem), timeout=30)
+        con.execute('PRAGMA journal_mode=WAL')
+        con.execute('CREATE TABLE IF NOT EXISTS _ledger_versions (name TEXT PRIMARY KEY, version INTEGER)')
+        return con
+
+    def column_type(self, column, values):
+        if column in MONEY_COLUMNS or values.dtype.kind in 'iub':
+            return 'INTEGER'
+        if values.dtype.kind == 'f':
+            return 'REAL'
+        return 'TEXT'
+
+    def table_columns(self, con, table):
+        return [row[1] for row in con.execute(f'PRAGMA table_info("{table}")')]
+
+    def exists(self, stem):
+        if not os.path.exists(self.path(stem)):
+            return False
+
+        with closing(self.connect(stem)) as con:
+            if not self.table_columns(con, self.table(stem)):
+                return False
+            return con.execute(f'SELECT 1 FROM "{self.table(stem)}" LIMIT 1').fetchone() is not None
+
+    def signature(self, stem):
+        with closing(self.connect(stem)) as con:
+            row = con.execute('SELECT version FROM _ledger_versions WHERE name = ?', (self.table(stem),)).fetchone()
+
+        return os.stat(self.path(stem)).st_ino, row[0] if row else 0
+
+    def columns(self, stem):
+        with closing(self.connect(stem)) as con:
+            return self.table_columns(con, self.table(stem))
+
+    def frame(self, con, sql, params=()):
+        '''
+        Run a query and type its result like a ledger read
+        '''
+        df = pd.read_sql_query(sql, con, params=params)
+        if 'Date' in df.columns:
+            # an empty result would otherwise come back in seconds rather
+            # than the microseconds of a parsed ledger
+            df['Date'] = pd.to_datetime(df['Date'], format='%Y-%m-%d').astype('datetime64[us]')
+        for column in df.columns.intersection(MONEY_COLUMNS):
+            if df.empty:
+                df[column] = df[column].astype('int64')
+            elif df[column].dtype.kind == 'f':
+                df[column] = df[column].astype('Int64')
+
+        return df
+
+    def select_columns(self, columns):
+        return ', '.join(f'"{column}"' for column in columns) if columns else '*'
+
+    def window(self, start=None, end=None, end_inclusive=True):
+        '''
+        Return the WHERE conditions and parameters keeping rows with a Date
+        between start and end
+        '''
+        conditions, params = [], []
+        if start is not None:
+            conditions.append('Date >= ?')
+            params.append(pd.Timestamp(start).strftime('%Y-%m-%d'))
+        if end is not None:
+            conditions.append('Date <= ?' if end_inclusive else 'Date < ?')
+            params.append(pd.Timestamp(end).strftime('%Y-%m-%d'))
+
+        return conditions, params
+
+    def read(self, stem, columns=None):
+        with closing(self.connect(stem)) as con:
+            return self.frame(con, f'SELECT {self.select_columns(columns)} FROM "{self.table(stem)}" ORDER BY rowid')
+
+    def date_span(self, stem):
+        '''
+        Return the first and last Date stored
+        '''
+        with closing(self.connect(stem)) as con:
+            first, last = con.execute(f'SELECT MIN(Date), MAX(Date) FROM "{self.table(stem)}"').fetchone()
+
+        return pd.Timestamp(first), pd.Timestamp(last)
+
+    def aggregate(self, stem, column, by=('Category',), start=None, end=None, end_inclusive=True, freq=None, agg='sum'):
+        '''
+        Sum column, or take its last value in date order, by the by columns
+        and by period when a frequency is given, over the rows with a Date
+        between start and end. Rows missing one of the by columns are left out
+        '''
+        keys = [f'"{key}"' for key in by] + ([self.PERIODS[freq]] if freq else [])
+        names = [f'"{key}"' for key in by] + (['Date'] if freq else [])
+        selected = ', '.join(f'{key} AS {name}' for key, name in zip(keys, names))
+
+        conditions, params = self.window(start, end, end_inclusive)
+        conditions += [f'"{key}" IS NOT NULL' for key in by]
+        where = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+        order = ', '.join(names)
+
+        if agg == 'sum':
+            sql = f'SELECT {selected}, SUM("{column}") AS "{column}" FROM "{self.table(stem)}" {where} GROUP BY {", ".join(keys)} ORDER BY {order}'
+        elif agg == 'last':
+            sql = (
+                f'SELECT {", ".join(names)}, "{column}" FROM ('
+                f'SELECT {selected}, "{column}", ROW_NUMBER() OVER (PARTITION BY {", ".join(keys)} ORDER BY Date DESC, rowid DESC) AS row_number '
+                f'FROM "{self.table(stem)}" {where}) WHERE row_number = 1 ORDER BY {order}'
+            )
+        else:
+            raise ValueError(f'Unknown aggregation {agg}, expected sum or last')
+
+        with closing(self.connect(stem)) as con:
+            return self.frame(con, sql, params)
+
+    def append(self, stem, df):
+        if df.empty:
+            return
+
+        table = self.table(stem)
+        with closing(self.connect(stem)) as con, con:
+            # the new rows must carry the same columns as the table
+            columns = self.table_columns(con, table)
+            if columns:
+                if sorted(columns) != sorted(df.columns):
+                    raise ValueError(f'Columns {df.columns.tolist()} do not match {columns} in {table}')
+                df = df[columns]
+            else:
+                columns = df.columns.tolist()
+                definitions = ', '.join(f'"{column}" {self.column_type(column, df[column])}' for column in columns)
+                con.execute(f'CREATE TABLE "{table}" ({definitions})')
+                if 'Date' in columns:
+                    con.execute(f'CREATE INDEX "{table}_date" ON "{table}" (Date)')
+                if 'Date' in columns and 'Category' in columns:
+                    con.execute(f'CREATE INDEX "{table}_category_date" ON "{table}" (Category, Date)')
+
+            rows = df.copy()
+            if 'Date' in rows.columns:
+                rows['Date'] = pd.to_datetime(rows['Date']).dt.strftime('%Y-%m-%d')
+            rows = rows.astype(object).where(rows.notna(), None)
+
+            placeholders = ', '.join('?' for _ in columns)
+            con.executemany(f'INSERT INTO "{table}" VALUES ({placeholders})', rows.itertuples(index=False, name=None))
+            con.execute('INSERT INTO _ledger_versions VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET version = version + 1', (table,))
+
+
+BACKENDS = {
+    'csv': CsvBackend(),
+    'parquet': ParquetBackend(),
+    'sqlite': SqliteBackend(),
+}
+
+
+##### Storage layouts #####
+
+class FlatLayout:
+    '''
+    Keep all of a ledger under a single stem, e.g. deductions.csv
+    '''
+    name = 'flat'
+    partitioned = False
+
+    def partitions(self, backend, ledger, start=None, end=None):
+        stem = os.path.join(DATA_PATH, ledger)
+        return [stem] if backend.exists(stem) else []
+
+    def split(self, ledger, df):
+        yield os.path.join(DATA_PATH, ledger), df
+
+
+class MonthlyLayout:
+    '''
+    Partition a ledger by the year and month of each row, e.g.
+    deductions/2025/06.csv, so reads bounded by date only open the months
+    overlapping the requested window
+    '''
+    name = 'monthly'
+    partitioned = True
+
+    # listings whose directories changed less than RECENT_NS ago aren't
+    # kept, a month added on the same clock tick as the listing would leave
+    # the modification times unchanged
+    RECENT_NS = 2 * 10**9
+
+    def __init__(self):
+        # the months stored for each ledger directory, kept along with the
+        # modification times of the directory and of its year directories at
+        # the time they were listed. Adding a month changes one of them
+        self._months = {}
+
+    def mtimes(self, root, years):
+        try:
+            return os.stat(root).st_mtime_ns, tuple(os.stat(os.path.join(root, year)).st_mtime_ns for year in years)
+        except FileNotFoundError:
+            return None
+
+    def months(self, backend, ledger):
+        '''
+        Return the sorted (year, month) pairs with data stored for the ledger.
+        The directories are only listed again once they change
+        '''
+        root = os.path.join(DATA_PATH, ledger)
+        cached = self._months.get((backend.name, root))
+        if cached and cached[0] == self.mtimes(root, cached[1]):
+            return cached[2]
+
+        # the modification times are taken before listing, so a month added
+        # while listing makes the next call list again
+        if not os.path.isdir(root):
+            return []
+        root_mtime = os.stat(root).st_mtime_ns
+        years = sorted(entry.name for entry in os.scandir(root) if entry.is_dir() and re.fullmatch(r'\d{4}', entry.name))
+        mtimes = self.mtimes(root, years)
+
+        months = []
+        complete = mtimes is not None and mtimes[0] == root_mtime
+        for year in years:
+            for entry in os.scandir(os.path.join(root, year)):
+                month = entry.name[:-len(backend.extension)]
+                if not entry.name.endswith(backend.extension) or not re.fullmatch(r'\d{2}', month):
+                    continue
+                if backend.exists(os.path.join(root, year, month)):
+                    months.append((int(year), int(month)))
+                else:
+                    # e.g. a parquet month whose first part isn't in place yet
+                    complete = False
+        months.sort()
+
+        if complete and time.time_ns() - max(mtimes[0], *mtimes[1]) > self.RECENT_NS:
+            self._months[(backend.name, root)] = (mtimes, years, months)
+
+        return months
+
+    def stem(self, ledger, year, month):
+        return os.path.join(DATA_PATH, ledger, f'{year:04d}', f'{month:02d}')
+
+    def partitions(self, backend, ledger, start=None, end=None):
+        # compare on (year, month) so any month overlapping the window is kept
+        start = pd.Timestamp(start) if start is not None else None
+        end = pd.Timestamp(end) if end is not None else None
+
+        stems = []
+        for year, month in self.months(backend, ledger):
+            if start is not None and (year, month) < (start.year, start.month):
+                continue
+            if end is not None and (year, month) > (end.year, end.month):
+                continue
+            stems.append(self.stem(ledger, year, month))
+
+        return stems
+
+    def split(self, ledger, df):
+        dates = pd.to_datetime(df['Date'])
+        for (year, month), group in df.groupby([dates.dt.year, dates.dt.month], sort=True):
+            yield self.stem(ledger, year, month), group
+
+
+LAYOUTS = {
+    'flat': FlatLayout(),
+    'monthly': MonthlyLayout(),
+}
+
+
+def check_storage(backend, layout):
+    '''
+    Raise a ValueError when the backend can't keep ledgers in the layout
+    '''
+    if layout.name not in backend.layouts:
+        raise ValueError(f'The {backend.name} backend does not support the {layout.name} layout, expected one of {list(backend.layouts)}')
+
+
+def get_backend(name=None):
+    '''
+    Return the storage backend with the given name, defaulting to the
+    configured STORAGE_BACKEND, which must support the configured layout
+    '''
+    configured = not name
+    name = name if name else STORAGE_BACKEND
+    if name not in BACKENDS:
+        raise ValueError(f'Unknown storage backend {name}, expected one of {list(BACKENDS)}')
+
+    if configured:
+        check_storage(BACKENDS[name], get_layout(STORAGE_LAYOUT))
+
+    return BACKENDS[name]
+
+
+def get_layout(name=None):
+    '''
+    Return the storage layout with the given name, defaulting to the
+    configured STORAGE_LAYOUT, which must be supported by the configured
+    backend
+    '''
+    configured = not name
+    name = name if name else STORAGE_LAYOUT
+    if name not in LAYOUTS:
+        raise ValueError(f'Unknown storage layout {name}, expected one of {list(LAYOUTS)}')
+
+    if configured:
+        check_storage(get_backend(STORAGE_BACKEND), LAYOUTS[name])
+
+    return LAYOUTS[name]
+
+
+##### Typed ledger loading #####
+
+def ledger_categories(ledger):
+    '''
+    Return the categories the ledger is known to hold, in a fixed order
+    '''
+    from src.categorize import get_matcher
+
+    if ledger == 'investments':
+        return INVESTMENT_CATEGORIES
+
+    categories = []
+    for source in CATEGORY_SOURCES.get(ledger, []):
+        _, rule_categories, _ = get_matcher(source)
+        categories += [category for category in rule_categories if category not in categories]
+    if ledger in CATEGORY_SOURCES and 'Misc' not in categories:
+        categories.append('Misc')
+
+    return categories
+
+
+def _typed(ledger, df):
+    '''
+    Load Category as a categorical holding the ledger's known categories
+    followed by any others found in the data, so group-bys run on the codes
+    and every partition of a ledger encodes its known categories the same
+    way. Integer columns are downcast to the smallest type holding their
+    values, sums still come out as int64
+    '''
+    if 'Category' in df.columns:
+        known = ledger_categories(ledger)
+        found = set(df['Category'].dropna().unique()) - set(known)
+        df['Category'] = pd.Categorical(df['Category'], categories=known + sorted(found))
+
+    for column in df.select_dtypes('integer').columns:
+        df[column] = pd.to_numeric(df[column], downcast='integer')
+
+    return df
+
+
+##### Process-wide ledger cache #####
+# parsed ledger partitions keyed on backend, path stem and projected columns,
+# along with the signature the stored data had when it was read. A partition
+# is only read again once the stored data changes
+_ledger_cache = {}
+_ledger_lock = threading.Lock()
+
+
+def _sort_by_date(df):
+    '''
+    Keep ledgers sorted by date so date windows can be found with a binary
+    search, and flag the frame as sorted so the check isn't repeated
+    '''
+    if 'Date' in df.columns:
+        if not df['Date'].is_monotonic_increasing:
+            df = df.sort_values(by='Date', kind='stable', ignore_index=True)
+        df.attrs['sorted_by_date'] = True
+
+    return df
+
+
+def _cached(key, signature, load):
+    with _ledger_lock:
+        cached = _ledger_cache.get(key)
+        if cached and cached[0] == signature:
+            return cached[1]
+
+    df = load()
+
+    with _ledger_lock:
+        _ledger_cache[key] = (signature, df)
+
+    return df
+
+
+def _forget_cached(ledger, partitions):
+    '''
+    Drop the cached frames of the given (stem, signature) partitions of a
+    ledger, and its combined frames
+    '''
+    stems = {stem for stem, _ in partitions}
+    with _ledger_lock:
+        for key in list(_ledger_cache):
+            if key[1] in stems or (len(key) == 5 and key[2] == ledger):
+                del _ledger_cache[key]
+
+
+def read_ledger(ledger, columns=None, start=None, end=None):
+    '''
+    Return the parsed contents of a ledger in the data directory, optionally
+    only the given columns. Date is typed, Category is categorical and
+    integer columns are downcast. When start or end are given only the
+    stored partitions overlapping that window are read, rows outside of the
+    window can still be returned so callers filter with select_dates.
+
+    The frame is shared between every caller and only re-read from disk when
+    the stored data changes, so it must be treated as read only
+    '''
+    backend = get_backend()
+    layout = get_layout()
+    columns = tuple(columns) if columns else None
+
+    stems = layout.partitions(backend, ledger, start, end)
+    if not stems:
+        raise FileNotFoundError(f'No data stored for the {ledger} ledger')
+
+    signatures = [backend.signature(stem) for stem in stems]
+    frames = [
+        _cached((backend.name, stem, columns), signature,
+                lambda stem=stem: _sort_by_date(_typed(ledger, backend.read(stem, columns=list(columns) if columns else None))))
+        for stem, signature in zip(stems, signatures)
+    ]
+    if len(frames) == 1:
+        return frames[0]
+
+    # keep the combined partitions as well so repeated reads of the same
+    # window don't concatenate again
+    key = (backend.name, layout.name, ledger, columns, tuple(stems))
+    return _cached(key, tuple(signatures), lambda: _sort_by_date(_typed(ledger, pd.concat(frames, ignore_index=True))))
+
+
+def ledger_version(ledger):
+    '''
+    Return a value that changes whenever data is written to the ledger, made
+    of the signatures of its stored partitions
+    '''
+    backend = get_backend()
+    layout = get_layout()
+    stems = layout.partitions(backend, ledger)
+
+    return backend.name, layout.name, tuple((stem, backend.signature(stem)) for stem in stems)
+
+
+def ledger_exists(ledger):
+    '''
+    Check if any data has been stored for the ledger
+    '''
+    return len(get_layout().partitions(get_backend(), ledger)) > 0
+
+
+def _write(backend, layout, ledger, df):
+    for stem, rows in layout.split(ledger, df):
+        backend.append(stem, rows)
+
+
+def write_ledger(ledger, df, keys=None):
+    '''
+    Append the new rows to the ledger, creating it if it does not exist yet.
+    Only the new rows are written so the cost of a write depends on the size
+    of the batch, not on the size of the ledger.
+
+    When keys are given, one fingerprint per row, rows whose fingerprint is
+    already in the ledger's dedup index, or repeated within the batch, are
+    skipped so overlapping uploads merge idempotently. Returns the rows that
+    were written
+    '''
+    backend = get_backend()
+    layout = get_layout()
+
+    # new partitions must carry the same columns as the rest of the ledger
+    stems = layout.partitions(backend, ledger)
+    if stems:
+        columns = backend.columns(stems[-1])
+        if sorted(columns) != sorted(df.columns):
+            raise ValueError(f'Columns {df.columns.tolist()} do not match {columns} in the {ledger} ledger')
+
+    if keys is None:
+        before = ledger_version(ledger)
+        _write(backend, layout, ledger, df)
+        ledger_store.apply(ledger, df, before, ledger_version(ledger))
+        return df
+
+    with _index_lock:
+        index = _load_index(ledger)
+        keys = keys.astype(str).to_numpy()
+        new = np.fromiter((key not in index for key in keys), dtype=bool, count=len(keys))
+        new &= ~pd.Series(keys).duplicated().to_numpy()
+        df, keys = df[new], keys[new]
+
+        # the rows go in before their fingerprints, a failure in between can
+        # only let a row through twice rather than lose it
+        before = ledger_version(ledger)
+        _write(backend, layout, ledger, df)
+        ledger_store.apply(ledger, df, before, ledger_version(ledger))
+        _append_index(ledger, keys)
+
+    return df
+
+
+##### Live ledger store #####
+# full ledgers held for the dashboard. Rows written by this process are
+# appended to the held frames instead of reading the ledger again, and every
+# change swaps in a new frame under a new version so readers holding the old
+# frame are never affected
+
+class LedgerStore:
+    '''
+    Versioned in memory copies of whole ledgers. get returns the current
+    version and frame of a ledger, loading it the first time or when it was
+    changed by another process. write_ledger hands every written batch to
+    apply, which adds the rows to the held frame
+    '''
+
+    def __init__(self):
+        self._ledgers = {}
+        self._lock = threading.Lock()
+        self._versions = itertools.count(1)
+
+    def get(self, ledger):
+        '''
+        Return the (version, frame) of the ledger. The frame is shared and
+        must be treated as read only
+        '''
+        while True:
+            signature = ledger_version(ledger)
+            with self._lock:
+                held = self._ledgers.get(ledger)
+                if held and held[0] == signature:
+                    return held[1], held[2]
+
+            df = read_ledger(ledger)
+
+            # a write landing during the read leaves rows in the frame that
+            # apply would add again under the old signature, so the frame is
+            # only held when the ledger didn't change while it was read
+            if ledger_version(ledger) != signature:
+                continue
+
+            with self._lock:
+                version = next(self._versions)
+                self._ledgers[ledger] = (signature, version, df)
+
+            return version, df
+
+    def apply(self, ledger, rows, before, after):
+        '''
+        Add rows just written to the ledger to the held frame. before and
+        after are the ledger versions around the write, if the held frame
+        isn't at before another writer got in between and the ledger is
+        loaded again on the next get instead
+        '''
+        with self._lock:
+            held = self._ledgers.get(ledger)
+            if held is None:
+                return
+            if held[0] != before:
+                del self._ledgers[ledger]
+                return
+            df = held[2]
+
+        if not rows.empty:
+            df = _sort_by_date(_concat_typed(ledger, df, rows))
+
+        with self._lock:
+            if self._ledgers.get(ledger) is held:
+                self._ledgers[ledger] = (after, next(self._versions), df)
+
+        # the frames read before the write are stale, drop them rather than
+        # keep them alongside the store's copy
+        _forget_cached(ledger, set(after[2]) - set(before[2]))
+
+    def clear(self):
+        with self._lock:
+            self._ledgers.clear()
+
+
+def _concat_typed(ledger, df, rows):
+    '''
+    Append rows to a typed ledger frame. New categories are added after the
+    existing ones so the held rows keep their codes
+    '''
+    rows = _typed(ledger, rows[df.columns.tolist()].copy())
+    if 'Category' in df.columns:
+        categories = df['Category'].cat.categories
+        found = rows['Category'].cat.categories.difference(categories)
+        dtype = pd.CategoricalDtype(categories.tolist() + sorted(found))
+        if len(found):
+            df = df.astype({'Category': dtype})
+        rows = rows.astype({'Category': dtype})
+
+    return pd.concat([df, rows], ignore_index=True)
+
+
+ledger_store = LedgerStore()
+
+
+##### Dedup index #####
+# fingerprints of every row written to a ledger, kept one per line in
+# <ledger>.fingerprints next to the ledgers so appends can check each new row
+# in constant time without reading the ledger back
+_indexes = {}
+_index_lock = threading.Lock()
+
+
+def index_path(ledger):
+    return os.path.join(DATA_PATH, f'{ledger}.fingerprints')
+
+
+def _load_index(ledger):
+    path = index_path(ledger)
+    if not os.path.exists(path):
+        return set()
+
+    signature = (path, os.stat(path).st_mtime_ns, os.stat(path).st_size)
+    cached = _indexes.get(ledger)
+    if cached and cached[0] == signature:
+        return cached[1]
+
+    with open(path) as f:
+        index = set(f.read().split())
+    _indexes[ledger] = (signature, index)
+
+    return index
+
+
+def _append_index(ledger, keys):
+    if len(keys) == 0:
+        return
+
+    path = index_path(ledger)
+    index = _load_index(ledger)
+    with open(path, 'a') as f:
+        f.write(''.join(f'{key}\n' for key in keys))
+        f.flush()
+        os.fsync(f.fileno())
+
+    index.update(keys)
+    _indexes[ledger] = ((path, os.stat(path).st_mtime_ns, os.stat(path).st_size), index)
+
+
+def clear_ledger_cache():
+    '''
+    Drop every cached ledger, forcing the next read to go back to disk
+    '''
+    with _ledger_lock:
+        _ledger_cache.clear()
+    ledger_store.clear()
+
+
+##### Migration #####
+
+def migrate_storage(backend='parquet', layout='flat'):
+    '''
+    One shot conversion of the flat CSV ledgers in the data directory to the
+    given backend and layout. Ledgers that already have data in the target
+    storage are left alone, apart from merging the parts of parquet ledgers
+    '''
+    source_backend, source_layout = get_backend('csv'), get_layout('flat')
+    target_backend, target_layout = get_backend(backend), get_layout(layout)
+    check_storage(target_backend, target_layout)
+    if (source_backend, source_layout) == (target_backend, target_layout):
+        return
+
+    for ledger in LEDGERS:
+        if not source_layout.partitions(source_backend, ledger):
+            continue
+        stems = target_layout.partitions(target_backend, ledger)
+        if stems:
+            for stem in stems:
+                if hasattr(target_backend, 'compact'):
+                    target_backend.compact(stem)
+            continue
+
+        df = source_backend.read(os.path.join(DATA_PATH, ledger))
+        _write(target_backend, target_layout, ledger, df)
+        print(f'migrated {ledger}: {len(df)} rows')
+
+
+if __name__ == '__main__':
+    # python -m src.storage [backend] [layout]
+    migrate_storage(*sys.argv[1:3])
@@ -4,264 +4,866 @@ import os
 import glob
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
-from pypdf import PdfReader
 import re
+import json
+import hashlib
+import threading
+import multiprocessing
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
 
-import package_root
+from src.categorize import categorize
+from src.storage import (read_ledger, write_ledger, ledger_exists, ledger_version, ledger_store,
+                         get_backend, get_layout, to_cents, write_json_atomic, data_path)
 
 
-DATA_PATH = os.path.join(package_root._root, 'data')
+##### Utilies functions for data preprocessing #####
+def select_dates(data: pd.DataFrame, start=None, end=None, end_inclusive: bool = True):
+    '''
+    Return the rows of data with a Date between start and end. Ledgers read
+    from storage are sorted by date, so the bounds are found with a binary
+    search and the rows sliced out instead of masking the whole frame
+    '''
+    dates = data['Date']
+    start = pd.Timestamp(start) if start is not None else None
+    end = pd.Timestamp(end) if end is not None else None
 
+    if data.attrs.get('sorted_by_date') or dates.is_monotonic_increasing:
+        lower = dates.searchsorted(start, side='left') if start is not None else 0
+        upper = dates.searchsorted(end, side='right' if end_inclusive else 'left') if end is not None else len(data)
+        return data.iloc[lower:upper]
 
-##### Utilies functions for data preprocessing #####
-def date_parser(data: pd.DataFrame, 
-                start_date: str = None, 
-                end_date: str = None, 
-                year: int = None, 
+    # fall back to masking for frames that aren't sorted
+    mask = pd.Series(True, index=data.index)
+    if start is not None:
+        mask &= dates >= start
+    if end is not None:
+        mask &= (dates <= end) if end_inclusive else (dates < end)
+
+    return data[mask]
+
+
+def date_window(start_date: str = None,
+                end_date: str = None,
+                year: int = None,
                 month: int = None):
-    
+    '''
+    Return the start, end, whether the end is inclusive, and the description
+    of the selected dates. Without any dates the current month is selected
+    '''
     current_time = datetime.now()
 
     if start_date and end_date:
-        subset = data[(data['Date'] >= start_date) & (data['Date'] <= end_date)]
-        date_string = f'{start_date} to {end_date}'
+        return start_date, end_date, True, f'{start_date} to {end_date}'
     elif start_date:
-        subset = data[data['Date'] >= start_date]
-        date_string = f'Everything After {start_date}'
+        return start_date, None, True, f'Everything After {start_date}'
     elif end_date:
-        subset = data[data['Date'] <= end_date]
-        date_string = f'Everything Up to {end_date}'
+        return None, end_date, True, f'Everything Up to {end_date}'
     elif year and not month:
-        subset = data[data['Date'].dt.year == year]
-        date_string = f'{year}'
+        start = datetime(year=year, month=1, day=1)
+        return start, start + relativedelta(years=1), False, f'{year}'
     else:
         year = year if year else current_time.year
         month = month if month else current_time.month
-        subset = data[(data['Date'].dt.year == year) & (data['Date'].dt.month == month)]
-        date_string = f'{year}-{month}'
+        start = datetime(year=year, month=month, day=1)
+        return start, start + relativedelta(months=1), False, f'{year}-{month}'
 
-    return subset, date_string
 
+##### Ledger queries #####
+# date windows and aggregates over a ledger are pushed down to the storage
+# backend when it can answer them, e.g. as SQL for the sqlite backend, so only
+# their results come back into Python. Other backends answer them in pandas
+# from the ledger store
 
-def write_file(file, df):
+def pushdown_stem(ledger):
     '''
-    Check if the file being written to exists, if it does concatenate the old
-    data with the new data, then write the data to the file  
+    Return the stem to push queries on the ledger down to, or None when the
+    backend can't answer them or the ledger is split over several partitions
     '''
-    if os.path.exists(file):
-        existing_data = pd.read_csv(file)
-        existing_data['Date'] = pd.to_datetime(existing_data['Date'], format='%Y-%m-%d')
-        df = pd.concat([existing_data, df])
-    
-    df.to_csv(file, index=False)
+    backend = get_backend()
+    if not hasattr(backend, 'aggregate'):
+        return None
+
+    stems = get_layout().partitions(backend, ledger)
+    return stems[0] if len(stems) == 1 else None
+
+
+def ledger_rows(ledger, columns, start=None, end=None, end_inclusive=True):
+    '''
+    Return the given columns of the ledger rows with a Date between start and
+    end. A partitioned ledger only has the partitions overlapping the window
+    read, each kept in memory until it changes, while a ledger kept whole
+    comes from the ledger store
+    '''
+    layout = get_layout()
+    if not layout.partitioned:
+        _, df = ledger_store.get(ledger)
+        return select_dates(df, start=start, end=end, end_inclusive=end_inclusive)
+
+    # an exclusive end on the first of a month doesn't reach into that month
+    last = pd.Timestamp(end) - pd.Timedelta(1, 'ns') if end is not None and not end_inclusive else end
+    if not layout.partitions(get_backend(), ledger, start, last):
+        # nothing stored in the window, the first month gives the empty rows
+        # their columns and types
+        year, month = layout.months(get_backend(), ledger)[0]
+        start = last = pd.Timestamp(year, month, 1)
+        end, end_inclusive = start, False
+
+    df = read_ledger(ledger, columns=list(dict.fromkeys(columns)), start=start, end=last)
+    return select_dates(df, start=start, end=end, end_inclusive=end_inclusive)
+
+
+def aggregate_ledger(ledger, column, by=('Category',), start=None, end=None, end_inclusive=True, freq=None, agg='sum'):
+    '''
+    Sum column, or take its last value in date order with agg='last', by the
+    by columns and by period when a pandas frequency of D, W, or ME is given,
+    over the rows with a Date between start and end. Returns the by columns,
+    then Date when grouped by period, then column
+    '''
+    stem = pushdown_stem(ledger)
+    if stem:
+        return get_backend().aggregate(stem, column, by, start, end, end_inclusive, freq, agg)
+
+    df = ledger_rows(ledger, list(by) + ['Date', column], start, end, end_inclusive)
+    keys = list(by) + ([pd.Grouper(key='Date', freq=freq)] if freq else [])
+    grouped = df.groupby(keys, observed=True)[column]
+
+    # grouping by period alone resamples, leave out the periods without any
+    # rows like the backends do. The ledgers hold downcast integers, widen
+    # them to int64 like a backend sum
+    values = grouped.agg(agg)[grouped.size() > 0]
+    if isinstance(df[column].dtype, np.dtype) and df[column].dtype.kind == 'i':
+        values = values.astype('int64')
+
+    return values.reset_index()
+
+
+def ledger_date_span(ledger):
+    '''
+    Return the first and last Date in the ledger, both NaT when it holds no
+    rows. Only the first and last month of a partitioned ledger are read
+    '''
+    stem = pushdown_stem(ledger)
+    if stem:
+        return get_backend().date_span(stem)
+
+    layout = get_layout()
+    if layout.partitioned:
+        months = [pd.Timestamp(year, month, 1) for year, month in layout.months(get_backend(), ledger)]
+        first = read_ledger(ledger, columns=['Date'], start=months[0], end=months[0]) if months else None
+        last = read_ledger(ledger, columns=['Date'], start=months[-1], end=months[-1]) if months else None
+    else:
+        _, first = ledger_store.get(ledger)
+        last = first
+
+    if first is None or first.empty or last.empty:
+        return pd.NaT, pd.NaT
+
+    return first['Date'].iloc[0], last['Date'].iloc[-1]
 
 
 ##### Function that read and preprocess input data #####
-def extract_credit_card_data():
-    path = os.path.join(DATA_PATH, 'credit_card_data')
-    cc_csv = glob.glob(f'{path}/*.csv')
+def row_fingerprints(df, columns):
+    '''
+    Fingerprint each row of a source export from the given columns. Repeats
+    of the same values within the export, e.g. two identical purchases on the
+    same day, are numbered so they keep distinct fingerprints while a second
+    upload of the same rows produces the same ones again
+    '''
+    fields = df[columns].astype(object).fillna('').astype(str)
+    occurrence = fields.groupby(columns).cumcount().astype(str)
+    joined = fields[columns[0]].str.cat([fields[column] for column in columns[1:]] + [occurrence], sep='\x1f')
 
-    if len(cc_csv) > 0:
-        df = pd.read_csv(cc_csv[0])
+    return joined.map(lambda value: hashlib.sha256(value.encode()).hexdigest()[:32])
+
+
+# exports larger than STREAM_THRESHOLD bytes are imported in chunks of about
+# CHUNK_SIZE rows so memory use doesn't grow with the size of the export
+STREAM_THRESHOLD = 50 * 1024 * 1024
+CHUNK_SIZE = 100000
+
+
+def stream_exports(exports, chunksize=None):
+    '''
+    Check if the exports should be imported in chunks, either because a chunk
+    size was asked for or because one of the exports is too large to read at
+    once
+    '''
+    return chunksize is not None or any(os.path.getsize(export) > STREAM_THRESHOLD for export in exports)
+
+
+def read_export_chunks(csv, date_column, chunksize=None):
+    '''
+    Read an export in chunks of about chunksize rows. The rows with the last
+    date of a chunk are held back and returned with the next one, so the rows
+    of a date always arrive together as long as the export is ordered by date
+    and repeated rows are fingerprinted the same way as a full read
+    '''
+    held = None
+    for chunk in pd.read_csv(csv, chunksize=chunksize if chunksize else CHUNK_SIZE):
+        if held is not None:
+            chunk = pd.concat([held, chunk], ignore_index=True)
+
+        last_date = chunk[date_column] == chunk[date_column].iloc[-1]
+        held = chunk[last_date]
+        if not last_date.all():
+            yield chunk[~last_date]
+
+    if held is not None and not held.empty:
+        yield held
+
+
+def prepare_credit_card_export(df):
+    '''
+    Reduce credit card export rows to the Category, Debit, and Date columns
+    kept in the credit card ledger
+    '''
+    # fingerprint the rows as exported, before they are recategorized, so
+    # changing the rules doesn't make old rows look new
+    df['Fingerprint'] = row_fingerprints(df, ['Transaction Date', 'Debit', 'Category', 'Description'])
 
-        # add grocery category
-        df.loc[df['Description'].str.contains('GIANT|ALDI|WEGMANS|WHOLEFDS|TRADER JOE|LIDL|HARRIS TEETER'), 'Category'] = 'Groceries'
+    # recategorize transactions using the credit card rules, e.g. groceries
+    df['Category'] = categorize(df['Description'], 'credit_card').fillna(df['Category'])
 
-        df['Date'] = pd.to_datetime(df['Transaction Date'], format='%Y-%m-%d')
-        df.dropna(axis=0, subset=['Debit'], inplace=True)
-        df.drop(['Transaction Date', 'Posted Date', 'Card No.', 'Description', 'Credit'], axis=1, inplace=True)
-        df.sort_values(by='Date', inplace=True)
+    df['Date'] = pd.to_datetime(df['Transaction Date'], format='%Y-%m-%d')
+    df.dropna(axis=0, subset=['Debit'], inplace=True)
+    df['Debit'] = to_cents(df['Debit'])
+    df.drop(['Transaction Date', 'Posted Date', 'Card No.', 'Description', 'Credit'], axis=1, inplace=True)
+
+    return df
+
+
+def read_credit_card_export(csv):
+    '''
+    Read a credit card export and reduce it to the Category, Debit, and Date
+    columns kept in the credit card ledger
+    '''
+    return prepare_credit_card_export(pd.read_csv(csv))
+
+
+def extract_credit_card_data(chunksize=None, progress=None):
+    '''
+    Parse every credit card export in the credit_card_data directory, write
+    them to the ledger in a single sorted write, and remove the exports once
+    the write succeeded. Large exports, or every export when a chunksize is
+    given, are streamed into the ledger a chunk at a time instead.
+
+    progress is called with the path of each export once it has been read
+    '''
+    path = data_path('credit_card_data')
+    cc_csv = sorted(glob.glob(f'{path}/*.csv'))
+
+    if len(cc_csv) > 0:
+        if stream_exports(cc_csv, chunksize):
+            for csv in cc_csv:
+                for chunk in read_export_chunks(csv, 'Transaction Date', chunksize):
+                    write_transactions('credit_card_data', prepare_credit_card_export(chunk))
+                if progress:
+                    progress(csv)
+        else:
+            exports = []
+            for csv in cc_csv:
+                exports.append(read_credit_card_export(csv))
+                if progress:
+                    progress(csv)
+            df = pd.concat(exports, ignore_index=True)
+            df.sort_values(by='Date', kind='stable', inplace=True)
     
-        file = os.path.join(DATA_PATH, 'credit_card_data.csv')
-        write_file(file, df)
-        os.remove(cc_csv[0])
+            write_transactions('credit_card_data', df)
 
+        for csv in cc_csv:
+            os.remove(csv)
 
-def parse_bank_pdf(pdf):
-    reader = PdfReader(pdf)
 
-    for idx in range(len(reader.pages)):
-        page = reader.pages[idx]
+# statement period and balance summary searched for on each statement page
+PERIOD_PATTERN = re.compile(r'For the period (\d\d\/\d\d\/\d\d\d\d) to (\d\d\/\d\d\/\d\d\d\d)')
+SUMMARY_PATTERN = re.compile(r'Balance Summary[\S\s]*Ending *\nbalance([\S\s]*)Average monthly')
 
-        content = page.extract_text()
+# number of worker processes used to parse statement PDFs
+PDF_WORKERS = int(os.environ.get('FINANCE_TRACKER_PDF_WORKERS', os.cpu_count() or 1))
+
+# the workers are started from the ingest thread of the running app, and
+# forking a process with other threads running can deadlock on the locks
+# they hold, so they are started from a clean server process instead
+PDF_CONTEXT = multiprocessing.get_context('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+
+
+def scan_pdf_pages(pdf, pages):
+    '''
+    Extract the text of the given pages and search each one for the statement
+    period and the balance summary. Returns a (period, summary, text) triple
+    for every page with None for anything that was not found
+    '''
+    from pypdf import PdfReader   # only loaded once a statement is parsed
+    reader = PdfReader(pdf)
+
+    results = []
+    for idx in pages:
+        content = reader.pages[idx].extract_text()
 
         # search for the start and end date of the statement period
-        date_range = re.search(r'For the period (\d\d\/\d\d\/\d\d\d\d) to (\d\d\/\d\d\/\d\d\d\d)', content)
-        if date_range:
-            start_date = date_range.group(1)
-            end_date = date_range.group(2)
+        date_range = PERIOD_PATTERN.search(content)
+        period = (date_range.group(1), date_range.group(2)) if date_range else None
 
         # search for the balance summary for the statement period. This
         # contains total value in the account, total added, and total
         # deducted
-        summary = re.search(r'Balance Summary[\S\s]*Ending *\nbalance([\S\s]*)Average monthly', content)
-        if summary:
-            totals = summary.group(1).replace(',','').strip().split(' ')[1:]
-            totals = [end_date] + totals[-1:] + totals[:-1]   # combine into list to be converted to df
+        summary = SUMMARY_PATTERN.search(content)
+        totals = summary.group(1).replace(',','').strip().split(' ')[1:] if summary else None
+
+        results.append((period, totals, content))
+
+    return results
+
+
+def build_statement(pdf, page_results):
+    '''
+    Combine the page results of a statement, in page order, into the period
+    start and end dates and a one row totals frame
+    '''
+    periods = [period for period, _, _ in page_results if period]
+    summaries = [totals for _, totals, _ in page_results if totals]
+    if not periods or not summaries:
+        raise ValueError(f'Could not find the statement period and balance summary in {pdf}')
+
+    start_date, end_date = periods[0]
+    totals = summaries[0]
+    totals = totals[-1:] + totals[:-1]   # reorder into total, added, lost
+
+    return start_date, end_date, statement_totals(end_date, totals)
+
+
+def statement_totals(end_date, totals):
+    '''
+    Build the one row totals frame of a statement from its end date and the
+    total, added, and lost dollar amounts
+    '''
+    df = pd.DataFrame({'Date': [end_date]})
+    df['Date'] = pd.to_datetime(df['Date'], format='%m/%d/%Y')
+    for column, amount in zip(['Total', 'Added', 'Lost'], totals):
+        df[column] = parse_amounts(pd.Series([amount]))
+
+    return df
+
+
+def read_bank_pdf(pdf, workers=1):
+    '''
+    Read the statement period and the balance summary from a bank statement,
+    returning the period start and end dates and the summary as a one row
+    totals frame.
+
+    Pages are scanned in waves of one page per worker, in parallel when more
+    than one worker is given, and scanning stops as soon as both the period
+    and the summary have been found
+    '''
+    from pypdf import PdfReader
+    n_pages = len(PdfReader(pdf).pages)
+    workers = max(1, min(workers, n_pages))
+
+    page_results = []
+    with ProcessPoolExecutor(max_workers=workers, mp_context=PDF_CONTEXT) if workers > 1 else nullcontext() as executor:
+        for wave in range(0, n_pages, workers):
+            pages = range(wave, min(wave + workers, n_pages))
+            if executor:
+                futures = [executor.submit(scan_pdf_pages, pdf, [idx]) for idx in pages]
+                page_results += [result for future in futures for result in future.result()]
+            else:
+                page_results += scan_pdf_pages(pdf, pages)
+
+            if any(period for period, _, _ in page_results) and any(totals for _, totals, _ in page_results):
+                break
+
+    start_date, end_date, df = build_statement(pdf, page_results)
+    pages = [content for _, _, content in page_results]
+
+    return start_date, end_date, df, pages
+
+
+def read_bank_pdfs(pdfs, workers=None, hashes=None, progress=None):
+    '''
+    Read several bank statements, returning the period start and end dates and
+    totals frame of each in the same order as pdfs.
+
+    Statements already in the statement cache are returned without being
+    parsed again. The rest are spread over a process pool, or the pages of a
+    single statement are when there is only one, and added to the cache.
+    progress is called with the path of each statement once it is read
+    '''
+    workers = workers if workers else PDF_WORKERS
+    hashes = hashes if hashes else [statement_hash(pdf) for pdf in pdfs]
+
+    with _statement_lock:
+        cache = load_statement_cache()
+
+    # parse each statement that isn't cached yet once, even if it was
+    # dropped in more than once
+    unseen = list({key: pdf for pdf, key in zip(pdfs, hashes) if key not in cache}.items())
+    if progress:
+        for pdf, key in zip(pdfs, hashes):
+            if key in cache:
+                progress(pdf)
+
+    parsed = []
+    if len(unseen) == 1 or workers <= 1:
+        for _, pdf in unseen:
+            parsed.append(read_bank_pdf(pdf, workers))
+            if progress:
+                progress(pdf)
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(unseen)), mp_context=PDF_CONTEXT) as executor:
+            for (_, pdf), result in zip(unseen, executor.map(read_bank_pdf, [pdf for _, pdf in unseen])):
+                parsed.append(result)
+                if progress:
+                    progress(pdf)
+
+    if unseen:
+        with _statement_lock:
+            cache = load_statement_cache()
+            for (key, _), (start_date, end_date, df, pages) in zip(unseen, parsed):
+                entry = cache.get(key, {})
+                entry.update({
+                    'start_date': start_date,
+                    'end_date': end_date,
+                    'totals': (df[['Total', 'Added', 'Lost']].iloc[0] / 100).tolist(),
+                })
+                if CACHE_PAGE_TEXT:
+                    entry['pages'] = pages
+                cache[key] = entry
+
+            save_statement_cache(cache)
 
-            df = pd.DataFrame([totals], columns=['Date', 'Total', 'Added', 'Lost'])
-            df['Date'] = pd.to_datetime(df['Date'], format='%m/%d/%Y')
+    return [cached_statement(cache[key]) for key in hashes]
 
-    # write new data to file and return statement period start and end dates
-    path = os.path.join(DATA_PATH, 'totals.csv')
-    write_file(path, df)
-    return start_date, end_date
 
+##### Statement cache #####
+# parsed statements keyed on the SHA-256 of the PDF, holding the statement
+# period and balance summary and whether the statement has been written to
+# the ledgers, so re-dropped statements are neither parsed nor ingested again
+STATEMENT_CACHE_FILE = 'statement_cache.json'
 
-def parse_bank_csv(csv, start_date, end_date):
-    data = pd.read_csv(csv)
+# also keep the text of the scanned pages in the cache
+CACHE_PAGE_TEXT = os.environ.get('FINANCE_TRACKER_CACHE_PAGE_TEXT', '0') == '1'
+
+_statement_lock = threading.Lock()
+
+
+def statement_hash(pdf):
+    '''
+    Return the SHA-256 of the statement's bytes
+    '''
+    digest = hashlib.sha256()
+    with open(pdf, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def load_statement_cache():
+    if not os.path.exists(data_path(STATEMENT_CACHE_FILE)):
+        return {}
+
+    with open(data_path(STATEMENT_CACHE_FILE)) as f:
+        return json.load(f)
+
+
+def save_statement_cache(cache):
+    write_json_atomic(data_path(STATEMENT_CACHE_FILE), cache)
+
+
+def cached_statement(entry):
+    '''
+    Rebuild the period start and end dates and the totals frame of a cached
+    statement
+    '''
+    return entry['start_date'], entry['end_date'], statement_totals(entry['end_date'], entry['totals'])
+
+
+def ingested_statements():
+    '''
+    Return the hashes of the statements already written to the ledgers
+    '''
+    with _statement_lock:
+        return {key for key, entry in load_statement_cache().items() if entry.get('ingested')}
+
+
+def mark_statements_ingested(hashes):
+    with _statement_lock:
+        cache = load_statement_cache()
+        for key in hashes:
+            cache.setdefault(key, {})['ingested'] = True
+        save_statement_cache(cache)
+
+
+def prepare_bank_transactions(data):
+    '''
+    Categorize bank transaction export rows
+    '''
     data['Date'] = pd.to_datetime(data['Transaction Date'], format='%Y-%m-%d')
+
+    # fingerprint the rows as exported, before they are recategorized, so
+    # changing the rules doesn't make old rows look new
+    data['Fingerprint'] = row_fingerprints(data, ['Transaction Date', 'Transaction Amount', 'Category', 'Transaction Description'])
     data = data.sort_values(by='Date')
 
-    # redo the category field to match desired categories
+    # redo the category field to match desired categories using the bank
+    # rules, anything left uncategorized is misc
     data.drop(['Balance'], axis=1, inplace=True)
-    data.loc[data['Transaction Description'].str.lower().str.contains('zel to albert secen|sheffield court|comcast'), 'Category'] = 'Rent'
-    data.loc[data['Transaction Description'].str.lower().str.contains('capital one|chase credit'), 'Category'] = 'Credit Card'
-    data.loc[data['Transaction Description'].str.lower().str.contains('drexel'), 'Category'] = 'Tuition'
-    data.loc[data['Transaction Description'].str.lower().str.contains('transfer'), 'Category'] = 'Transfer'
-    data.loc[data['Transaction Description'].str.lower().str.contains('leidos'), 'Category'] = 'Paycheck'
+    data['Category'] = categorize(data['Transaction Description'], 'bank').fillna(data['Category'])
     data.loc[data['Category'].isna(), 'Category'] = 'Misc'
 
-    # keep only account withdrawls falling within the statement dates and save to file
-    deducations = data[data['Transaction Amount'].str.contains('-')]
-    # deducations = data[data['Deposits'].isna()]
-    deducations = deducations[(deducations['Date'] >= start_date) & (deducations['Date'] <= end_date)]
-    deducations['Amount'] = deducations['Transaction Amount'].str.replace('- ', '').str.replace('$', '').str.replace(',', '').astype(float)
-    deducations.drop(['Transaction Date', 'Transaction Description', 'Transaction Amount'], axis=1, inplace=True)
-    deducations = deducations[['Date', 'Amount', 'Category']]
+    return data
+
 
-    path = os.path.join(DATA_PATH, 'deductions.csv')
-    write_file(path, deducations)
+def read_bank_csv(csv):
+    '''
+    Read a bank transaction export and categorize the transactions
+    '''
+    return prepare_bank_transactions(pd.read_csv(csv))
 
-    # keep only account deposits falling within the statement dates and save to file
-    additions = data[~data['Transaction Amount'].str.contains('-')]
-    additions = additions[(additions['Date'] >= start_date) & (additions['Date'] <= end_date)]
-    additions['Amount'] = additions['Transaction Amount'].str.replace('+ ', '').str.replace('$', '').str.replace(',', '').astype(float)
-    additions.drop(['Transaction Date', 'Transaction Description', 'Transaction Amount'], axis=1, inplace=True)
-    additions = additions[['Date', 'Amount', 'Category']]
 
-    path = os.path.join(DATA_PATH, 'additions.csv')
-    write_file(path, additions)
+# characters dropped from bank amounts like "- $1,234.56" before conversion
+AMOUNT_TRANSLATION = str.maketrans('', '', '$, +')
 
 
-def extract_bank_data():
+def parse_amounts(amounts):
+    '''
+    Convert bank amount strings like "- $1,234.56" into signed integer cents
+    '''
+    amounts = pd.to_numeric(amounts.astype(str).str.translate(AMOUNT_TRANSLATION), errors='raise')
+
+    return pd.Series(np.rint(amounts.to_numpy(dtype=float) * 100).astype('int64'), index=amounts.index)
+
+
+def split_bank_transactions(data, start_date, end_date):
+    '''
+    Split the bank transactions falling within the statement dates into
+    deductions and additions
+    '''
+    # keep only transactions falling within the statement dates
+    data = data[(data['Date'] >= start_date) & (data['Date'] <= end_date)]
+    cents = parse_amounts(data['Transaction Amount'])
+    data = data[['Date', 'Category', 'Fingerprint']].assign(Amount=cents.abs())[['Date', 'Amount', 'Category', 'Fingerprint']]
+
+    # withdrawls are the negative amounts, deposits everything else
+    withdrawl = (cents < 0).to_numpy()
+    deducations = data[withdrawl]
+    additions = data[~withdrawl]
+
+    return deducations, additions
+
+
+def split_statement_transactions(statements, transactions):
+    '''
+    Split the transactions into deductions and additions for each statement,
+    combined over the statements
+    '''
+    splits = [split_bank_transactions(transactions, start_date, end_date) for start_date, end_date, _ in statements]
+    deducations = pd.concat([deducations for deducations, _ in splits]).sort_values(by='Date', kind='stable')
+    additions = pd.concat([additions for _, additions in splits]).sort_values(by='Date', kind='stable')
+
+    return deducations, additions
+
+
+def extract_bank_data(chunksize=None, progress=None):
     '''
     check that the bank data source files exists, parse the data, and remove
-    the data source files
+    the data source files.
+
+    Every statement PDF in bank_data is parsed along with every transaction
+    export. The exports are pooled so they don't have to line up one to one
+    with the statements, each statement keeps the transactions falling in
+    its own period. Each ledger then gets a single sorted write, and the
+    source files are only removed once every write succeeded.
+
+    Large exports, or every export when a chunksize is given, are streamed
+    into the ledgers a chunk at a time instead of being pooled. progress is
+    called with the path of each statement and export once it has been read,
+    or with the reason it was skipped for files that weren't ingested.
+    Exports are only removed once they were read, without a new statement
+    they are kept for the next upload
     '''
-    path = os.path.join(DATA_PATH, 'bank_data')
-    statement_csv = glob.glob(f'{path}/*.csv')
-    statement_pdf = glob.glob(f'{path}/*.pdf')
+    path = data_path('bank_data')
+    statement_csv = sorted(glob.glob(f'{path}/*.csv'))
+    statement_pdf = sorted(glob.glob(f'{path}/*.pdf'))
 
     print(statement_csv)
     print(statement_pdf)
 
     if len(statement_pdf) > 0 and len(statement_csv) > 0:
-        start_date, end_date = parse_bank_pdf(statement_pdf[0])
-        parse_bank_csv(statement_csv[0], start_date, end_date)
-
-        os.remove(statement_pdf[0])
-        os.remove(statement_csv[0])
+        # skip statements that were already uploaded, or dropped in twice, so
+        # their totals and transactions aren't written again
+        ingested = ingested_statements()
+        new_pdf, new_hashes = [], []
+        for pdf, key in zip(statement_pdf, [statement_hash(pdf) for pdf in statement_pdf]):
+            if key in ingested or key in new_hashes:
+                if progress:
+                    progress(pdf, skipped='the statement has already been uploaded')
+                continue
+            new_pdf.append(pdf)
+            new_hashes.append(key)
+
+        if new_pdf:
+            statements = read_bank_pdfs(new_pdf, hashes=new_hashes, progress=progress)
+            totals = pd.concat([summary for _, _, summary in statements]).sort_values(by='Date', kind='stable')
+
+            if stream_exports(statement_csv, chunksize):
+                # the fingerprint index keeps a stream that failed part way
+                # from writing the same rows twice when it is run again
+                for csv in statement_csv:
+                    for chunk in read_export_chunks(csv, 'Transaction Date', chunksize):
+                        deducations, additions = split_statement_transactions(statements, prepare_bank_transactions(chunk))
+                        write_transactions('deductions', deducations)
+                        write_transactions('additions', additions)
+                    if progress:
+                        progress(csv)
+                write_snapshots('totals', totals)
+            else:
+                exports = []
+                for csv in statement_csv:
+                    exports.append(read_bank_csv(csv))
+                    if progress:
+                        progress(csv)
+                transactions = pd.concat(exports, ignore_index=True)
+                deducations, additions = split_statement_transactions(statements, transactions)
+
+                write_snapshots('totals', totals)
+                write_transactions('deductions', deducations)
+                write_transactions('additions', additions)
+
+            mark_statements_ingested(new_hashes)
+            processed = statement_pdf + statement_csv
+        else:
+            # without a new statement the exports have no period to be split
+            # by, keep them for the next upload
+            for csv in statement_csv:
+                if progress:
+                    progress(csv, skipped='no new statement to match it against, kept for the next upload')
+            processed = statement_pdf
+
+        for file in processed:
+            os.remove(file)
 
 
 ##################################################################################
 
-def get_lookback_data(filename, n_months=None):
+##### Monthly rollup #####
+# month by category sums for each transaction ledger, kept in the
+# monthly_rollup ledger and added to whenever new transactions are written so
+# the summaries never have to aggregate the raw transactions
+
+ROLLUP_SOURCES = {'deductions': 'Amount', 'additions': 'Amount', 'credit_card_data': 'Debit'}
+_rollup_lock = threading.Lock()
+
+
+def rollup_rows(source, df):
     '''
-    used to collect a subset of data, looking backwards in time for a certain
-    number of months. If no number of months is provided just look at the most
-    recent month in the data.
+    Sum the transactions in df by month and category. Each month is labelled
+    with its month end date, matching pd.Grouper(freq='ME')
     '''
-    path = os.path.join(DATA_PATH, filename)
-    df = pd.read_csv(path)
-    df['Date'] = pd.to_datetime(df['Date'], format='%Y-%m-%d')
+    month = df['Date'].dt.normalize() + pd.offsets.MonthEnd(0)
+    group = df.groupby([month, df['Category']], observed=True, dropna=False)[ROLLUP_SOURCES[source]].sum()
 
-    # find the latest month and year in the existing data
-    year = df.iloc[-1]['Date'].year
-    month = df.iloc[-1]['Date'].month
-    
-    if n_months:
-        # if number of months to look back is provided, create a datetime 
-        # object and subtract the given time delta, given the desired start
-        # date
-        dt = datetime(year=year, month=month, day=1)
-        new_dt = dt - relativedelta(months=n_months)
-        start_date = new_dt.strftime('%Y-%m-%d')
-
-        subset, _ = date_parser(df, start_date=start_date)
-    else:
-        subset, _ = date_parser(df, year=year, month=month)
+    rollup = group.reset_index()
+    rollup.columns = ['Date', 'Category', 'Amount']
+    rollup.insert(1, 'Source', source)
 
-    return subset
+    return rollup
 
 
-def get_spending(cum_type, n_months=0):
-    rets = {'Rent': 0, 'Credit Card': 0, 'Misc': 0}   # initialize return values in dict
-    subset = get_lookback_data('deductions.csv', n_months=n_months)
+def write_transactions(ledger, df):
+    '''
+    Write new transactions to the ledger and add their monthly sums to the
+    rollup. Transactions carrying a Fingerprint are checked against the
+    ledger's dedup index so rows that were already uploaded are skipped
+    '''
+    keys = None
+    if 'Fingerprint' in df.columns:
+        keys = df['Fingerprint']
+        df = df.drop(columns='Fingerprint')
+
+    # the ledger and the rollup are written under the one lock, otherwise a
+    # rollup rebuilt in between would already hold the new rows and they
+    # would be added to it a second time
+    with _rollup_lock:
+        df = write_ledger(ledger, df, keys=keys)
+        if ledger_exists('monthly_rollup') and not df.empty:
+            write_ledger('monthly_rollup', rollup_rows(ledger, df))
 
-    # sum cumulation
-    if cum_type:
-        group = subset.groupby(['Category'])['Amount'].sum()
-        # loop over the return keys and add sum to the return dict
-        for k, _ in rets.items():
-            try:
-                rets[k] = float(group[k])
-            except:
-                continue
-    # average cumulation
-    else:
-        categories = subset['Category'].unique().tolist()   # present categories in the desired subset of data
-        # get only the data for each category, sum over each month present in the data, then take the average
-        # of those sums to get the rolling average for each category
-        for k, _ in rets.items():
-            if k in categories:
-                cat_subset = subset[subset['Category'] == k]
-                cat_totals_by_month = cat_subset.groupby(pd.Grouper(key='Date', freq='ME'))['Amount'].sum()
-                rets[k] = np.mean(cat_totals_by_month)
 
-    return tuple(rets.values())
+def rebuild_rollup():
+    '''
+    Build the rollup from the full transaction ledgers, used the first time
+    the rollup is needed for data written before it existed. Nothing is
+    written while there are no transactions
+    '''
+    rollups = [rollup_rows(source, read_ledger(source)) for source in ROLLUP_SOURCES if ledger_exists(source)]
+    if rollups:
+        write_ledger('monthly_rollup', pd.concat(rollups, ignore_index=True))
 
 
-def get_totals(cum_type, n_months=0):
-    # get deposits and withdrawls from the past n months
-    add_subset = get_lookback_data('additions.csv', n_months=n_months)
-    add_subset = add_subset[add_subset['Category'] != 'Transfer']
-    ded_subset = get_lookback_data('deductions.csv', n_months=n_months)
+def summary_values(rollup, cum_type, n_months=0):
+    '''
+    Sum or average the additions and deductions rollup rows inside the
+    lookback window by source and category, along with the totals used for
+    savings
+    '''
+    source = rollup['Source'].astype(str)
+    category = rollup['Category'].astype(str)
+
+    # keep the lookback window of each ledger, counted back from its own
+    # latest month
+    latest = rollup.groupby(source)['Date'].transform('max')
+    in_window = rollup['Date'] >= latest - pd.offsets.MonthEnd(n_months if n_months else 0)
+
+    # label every row with the per category key it counts towards, additions
+    # other than transfers and all deductions also count towards the totals
+    # used for savings
+    keys = source + ':' + category
+    totals = source.where((source == 'deductions') | (category != 'Transfer')) + ':*'
+    rows = pd.concat([
+        pd.DataFrame({'Date': rollup['Date'], 'Key': keys, 'Amount': rollup['Amount']})[in_window],
+        pd.DataFrame({'Date': rollup['Date'], 'Key': totals, 'Amount': rollup['Amount']})[in_window & totals.notna()],
+    ])
+    by_month = rows.pivot_table(index='Date', columns='Key', values='Amount', aggfunc='sum')
 
-    # sum
     if cum_type:
-        cumm_adds = sum(add_subset['Amount'])
-        cumm_deds = sum(ded_subset['Amount'])
-    # average
+        values = by_month.sum()
     else:
-        # group by month and sum the values within the months, then get the average over the months
-        cumm_adds = np.mean(add_subset.groupby(pd.Grouper(key='Date', freq='ME')).sum()['Amount'])
-        cumm_deds = np.mean(ded_subset.groupby(pd.Grouper(key='Date', freq='ME')).sum()['Amount'])
-    
-    return cumm_adds - cumm_deds
+        # months between the first and last month of each key without any
+        # transactions count as zero, like pd.Grouper does
+        months = pd.date_range(by_month.index.min(), by_month.index.max(), freq='ME')
+        by_month = by_month.reindex(months)
+        present = by_month.notna()
+        inside = present.cummax() & present[::-1].cummax()[::-1]
+        values = by_month.fillna(0).where(inside).mean()
 
+    return values
 
-def get_income(cum_type, n_months=0):
-    # get the additions for the n months previous months 
-    subset = get_lookback_data('additions.csv', n_months=n_months)
-    # sum
-    if cum_type:
-        group = subset.groupby(['Category'])['Amount'].sum()
-        income = float(group['Paycheck'])
-    # average
-    else:
-        # get only the income, groupby months, sum by the month and return the average between
-        # the months
-        cat_subset = subset[subset['Category'] == 'Paycheck']
-        cat_totals_by_month = cat_subset.groupby(pd.Grouper(key='Date', freq='ME'))['Amount'].sum()
-        income = np.mean(cat_totals_by_month)    
 
-    return income
+def get_summary(cum_type, n_months=0):
+    '''
+    Compute income, rent, credit card spending, misc spending, and savings in
+    one pass over the monthly rollup. Each ledger looks back from its own
+    latest month, and a window without any Paycheck has 0 income when summing.
+    Like the ledgers, every value is in cents. Before any bank transactions are
+    uploaded the values are the same as for a window without any transactions
+    '''
+    with _rollup_lock:
+        if not ledger_exists('monthly_rollup'):
+            rebuild_rollup()
 
+    values = pd.Series(dtype=float)
+    if ledger_exists('monthly_rollup'):
+        rollup = aggregate_ledger('monthly_rollup', 'Amount', by=['Source', 'Category'], freq='ME')
+        rollup = rollup[rollup['Source'].isin(['additions', 'deductions'])]
+        if not rollup.empty:
+            values = summary_values(rollup, cum_type, n_months)
+
+    def metric(key, missing):
+        return float(values[key]) if key in values.index else missing
+
+    missing_mean = 0.0 if cum_type else np.nan
+    summary = {
+        'income': metric('additions:Paycheck', missing_mean),
+        'rent': metric('deductions:Rent', 0),
+        'credit': metric('deductions:Credit Card', 0),
+        'misc': metric('deductions:Misc', 0),
+        'saved': metric('additions:*', missing_mean) - metric('deductions:*', missing_mean),
+    }
+
+    return summary
+
+
+##### Latest snapshot index #####
+# the latest balance of each investment account and the latest bank total,
+# kept in latest.json along with the version of the ledger they were taken
+# from, so the total assets are found without reading the ledgers. A ledger
+# changed without going through write_snapshots is indexed again from its
+# contents the next time the index is loaded
+LATEST_FILE = 'latest.json'
+
+# snapshot ledgers with the column holding the balance. When several rows
+# share the latest date the last one written wins, like the last value the
+# investments chart plots, so a same day correction replaces the balance
+SNAPSHOT_LEDGERS = {'investments': 'Amount', 'totals': 'Total'}
+_latest_lock = threading.RLock()
 
-def update_investment_data(input_data):
-    investments_path = os.path.join(DATA_PATH, 'investments.csv')
 
+def snapshot_version(ledger):
+    # the ledger version as it reads back from JSON, with its stems relative
+    # to the data directory so the index doesn't depend on where it lives
+    backend, layout, partitions = ledger_version(ledger)
+    partitions = [(os.path.relpath(stem, data_path()), signature) for stem, signature in partitions]
+
+    return json.loads(json.dumps([backend, layout, partitions]))
+
+
+def fold_snapshots(ledger, df, snapshots):
+    '''
+    Update the latest snapshots of a ledger with the rows of df, one per
+    Category for investments and a single one for the bank total
+    '''
+    column = SNAPSHOT_LEDGERS[ledger]
+    keys = df['Category'].astype(object) if 'Category' in df.columns else pd.Series(column, index=df.index)
+
+    for key, date, amount in zip(keys, df['Date'].dt.strftime('%Y-%m-%d'), df[column]):
+        if pd.isna(key):
+            continue
+        held = snapshots.get(key)
+        if held is None or date >= held[0]:
+            snapshots[key] = [date, int(amount)]
+
+
+def load_latest():
+    '''
+    Load the latest snapshot index, indexing any ledger that changed since
+    its snapshots were taken again
+    '''
+    with _latest_lock:
+        latest = {}
+        if os.path.exists(data_path(LATEST_FILE)):
+            with open(data_path(LATEST_FILE)) as f:
+                latest = json.load(f)
+
+        changed = False
+        for ledger in SNAPSHOT_LEDGERS:
+            version = snapshot_version(ledger)
+            if ledger in latest and latest[ledger]['version'] == version:
+                continue
+
+            snapshots = {}
+            if ledger_exists(ledger):
+                fold_snapshots(ledger, read_ledger(ledger), snapshots)
+            latest[ledger] = {'version': version, 'snapshots': snapshots}
+            changed = True
+
+        if changed:
+            save_latest(latest)
+
+    return latest
+
+
+def save_latest(latest):
+    write_json_atomic(data_path(LATEST_FILE), latest)
+
+
+def write_snapshots(ledger, df):
+    '''
+    Write investment balances or bank totals to their ledger and fold them
+    into the latest snapshot index
+    '''
+    with _latest_lock:
+        latest = load_latest()
+        write_ledger(ledger, df)
+
+        entry = latest[ledger]
+        fold_snapshots(ledger, df, entry['snapshots'])
+        entry['version'] = snapshot_version(ledger)
+        save_latest(latest)
+
+
+def update_investment_data(input_data):
     # create a dataframe from the input data and write to file
     current_time = datetime.now()
     day = current_time.date()
@@ -269,27 +871,24 @@ def update_investment_data(input_data):
     data = [[day, v, k] for k, v in input_data.items() if v]
     df = pd.DataFrame(data, columns=cols)
     df['Date'] = pd.to_datetime(df['Date'], format='%Y-%m-%d')
+    df['Amount'] = to_cents(df['Amount'])
 
-    write_file(investments_path, df)
+    write_snapshots('investments', df)
 
 
 def get_total_assets():
-    investments_path = os.path.join(DATA_PATH, 'investments.csv')
-    totals_path = os.path.join(DATA_PATH, 'totals.csv')
-
-    # read in investment data, find the latest investment entry for each type, combine
-    # with latest bank statement and return total
-    investment_df = pd.read_csv(investments_path)
-    investment_df['Date'] = pd.to_datetime(investment_df['Date'], format='%Y-%m-%d')
+    # look up the latest investment entry for each type and the latest bank
+    # statement total in the snapshot index and return total in cents.
+    # Anything not uploaded yet counts as 0
+    latest = load_latest()
     investments = ['etrade', 'leidos', 'retirement', 'cambridge']
-    grouping = investment_df.loc[investment_df.groupby('Category').Date.idxmax()]
-    total_investments = grouping[grouping['Category'].isin(investments)]['Amount'].sum()
+    snapshots = latest['investments']['snapshots']
+    total_investments = sum(snapshots[k][1] for k in investments if k in snapshots)
 
-    bank_df = pd.read_csv(totals_path)
-    bank_df['Date'] = pd.to_datetime(bank_df['Date'], format='%Y-%m-%d')
-    bank_total = bank_df.iloc[-1]['Total']
+    bank = latest['totals']['snapshots'].get('Total')
+    bank_total = bank[1] if bank else 0
 
-    return total_investments+bank_total
+    return int(total_investments + bank_total)
 
     
     
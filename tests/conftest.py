@@ -0,0 +1,19 @@
+import pytest
+
+import src.categorize as categorize
+import src.plotting as plotting
+import src.storage as storage
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    '''
+    Point the ledgers, indexes and caches at an empty data directory
+    '''
+    monkeypatch.setattr(storage, 'DATA_PATH', str(tmp_path))
+    monkeypatch.setattr(categorize, '_description_cache', None)
+    storage.clear_ledger_cache()
+    plotting.clear_figure_cache()
+    yield tmp_path
+    storage.clear_ledger_cache()
+    plotting.clear_figure_cache()
@@ -0,0 +1,18 @@
+import os
+
+import src.plotting as plotting
+import src.utils as utils
+
+
+def test_same_day_investment_correction_wins(data_dir):
+    utils.update_investment_data({'etrade': 1000})
+    utils.update_investment_data({'etrade': 1500})
+
+    assert utils.get_total_assets() == 150000
+
+    # the index rebuilt from the ledger agrees
+    os.remove(data_dir / utils.LATEST_FILE)
+    assert utils.get_total_assets() == 150000
+
+    line = plotting.ledger_line_chart('investments', credit=False, agg='last')
+    assert list(line.data[0].y) == [1500.0]
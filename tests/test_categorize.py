@@ -0,0 +1,65 @@
+import json
+import os
+
+import pandas as pd
+import pytest
+
+import src.categorize as categorize
+
+
+DESCRIPTIONS = pd.Series(['AMAZON FRESH #12', 'amazon marketplace', 'Fresh Market', 'GAS STATION', None])
+
+
+@pytest.fixture
+def rules(data_dir, monkeypatch):
+    '''
+    Write the given rules for the bank source to a rules file the matcher
+    reads from
+    '''
+    path = data_dir / 'rules.json'
+    monkeypatch.setattr(categorize, 'RULES_PATH', str(path))
+    monkeypatch.setattr(categorize, '_matchers', {})
+
+    def write(*rules, ignore_case=True):
+        config = {'bank': {'ignore_case': ignore_case,
+                           'rules': [{'pattern': pattern, 'category': category} for pattern, category in rules]}}
+        path.write_text(json.dumps(config))
+
+        # the matcher is rebuilt when the file's modification time changes,
+        # two writes in a row can land on the same clock tick
+        written.append(len(written) + 1)
+        os.utime(path, ns=(written[-1], written[-1]))
+
+    written = []
+    return write
+
+
+def assigned():
+    return categorize.categorize(DESCRIPTIONS, 'bank').fillna('unmatched').tolist()
+
+
+def test_first_matching_rule_wins(rules):
+    rules(('amazon fresh', 'Groceries'), ('amazon', 'Shopping'), ('fresh', 'Produce'))
+
+    assert assigned() == ['Groceries', 'Shopping', 'Produce', 'unmatched', 'unmatched']
+
+
+def test_rule_order_changes_the_category(rules):
+    rules(('amazon', 'Shopping'), ('amazon fresh', 'Groceries'), ('fresh', 'Produce'))
+
+    assert assigned() == ['Shopping', 'Shopping', 'Produce', 'unmatched', 'unmatched']
+
+
+def test_changed_rules_recategorize_cached_descriptions(rules):
+    rules(('amazon fresh', 'Groceries'), ('amazon', 'Shopping'))
+    categorize.categorize(DESCRIPTIONS, 'bank')
+
+    # a later rule that now comes first replaces the cached categories
+    rules(('fresh', 'Produce'), ('amazon', 'Shopping'))
+    assert assigned() == ['Produce', 'Shopping', 'Produce', 'unmatched', 'unmatched']
+
+
+def test_case_sensitive_rules(rules):
+    rules(('AMAZON', 'Shopping'), ignore_case=False)
+
+    assert assigned() == ['Shopping', 'unmatched', 'unmatched', 'unmatched', 'unmatched']
@@ -0,0 +1,64 @@
+import pandas as pd
+
+import src.plotting as plotting
+import src.storage as storage
+import src.utils as utils
+
+
+def test_empty_write_creates_no_ledger(data_dir):
+    empty = pd.DataFrame({'Category': pd.Series(dtype=object),
+                          'Debit': pd.Series(dtype='int64'),
+                          'Date': pd.Series(dtype='datetime64[ns]')})
+    storage.write_ledger('credit_card_data', empty)
+
+    assert not storage.ledger_exists('credit_card_data')
+    assert not (data_dir / 'credit_card_data.csv').exists()
+
+
+def test_charts_of_header_only_ledger(data_dir):
+    # earlier versions left a header-only ledger behind after an upload
+    # without any new transactions
+    (data_dir / 'credit_card_data.csv').write_text('Category,Debit,Date\n')
+
+    assert all(pd.isna(date) for date in utils.ledger_date_span('credit_card_data'))
+
+    line = plotting.ledger_line_chart('credit_card_data', credit=True, version=storage.ledger_version('credit_card_data'))
+    assert len(line.data) == 0
+
+    pie = plotting.ledger_pie_chart('credit_card_data', year=2025, month=1, credit=True)
+    assert len(pie.data[0].labels) == 0
+
+
+def test_zoomed_range_from_relayout():
+    assert plotting.zoomed_range(None) is None
+    assert plotting.zoomed_range({'autosize': True}) is None
+    assert plotting.zoomed_range({'xaxis.autorange': True, 'yaxis.autorange': True}) == (None, None)
+    assert plotting.zoomed_range({'xaxis.range[0]': '2024-01-01', 'xaxis.range[1]': '2024-02-01'}) == ('2024-01-01', '2024-02-01')
+    assert plotting.zoomed_range({'xaxis.range': ['2024-01-01', '2024-02-01']}) == ('2024-01-01', '2024-02-01')
+
+
+def test_zoomed_line_chart_picks_frequency_from_visible_range(data_dir):
+    days = pd.date_range('2012-01-01', '2024-12-31')
+    storage.write_ledger('credit_card_data', pd.DataFrame({'Category': 'Dining', 'Debit': 100, 'Date': days}))
+    version = storage.ledger_version('credit_card_data')
+
+    full = plotting.ledger_line_chart('credit_card_data', version=version)
+    assert 'Monthly' in full.layout.title.text
+
+    zoomed = plotting.ledger_line_chart('credit_card_data', version=version,
+                                        start='2024-03-01 06:00:00', end='2024-05-31 18:00:00')
+    assert 'Daily' in zoomed.layout.title.text
+    assert list(zoomed.layout.xaxis.range) == ['2024-03-01 06:00:00', '2024-05-31 18:00:00']
+    assert len(zoomed.data[0].x) == 92
+
+
+def test_zoomed_line_chart_shows_whole_periods(data_dir):
+    days = pd.date_range('2012-01-01', '2024-12-31')
+    storage.write_ledger('credit_card_data', pd.DataFrame({'Category': 'Dining', 'Debit': 100, 'Date': days}))
+
+    # a range of a few years starting on a Wednesday is shown weekly, the
+    # first week still sums all seven days
+    zoomed = plotting.ledger_line_chart('credit_card_data', start='2020-01-08', end='2023-06-30')
+    assert 'Weekly' in zoomed.layout.title.text
+    assert zoomed.data[0].y[0] == 7.0
+    assert zoomed.data[0].y[-1] == 7.0
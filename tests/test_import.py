@@ -0,0 +1,92 @@
+import pandas as pd
+import pytest
+
+import src.storage as storage
+import src.utils as utils
+
+
+# credit card purchases as exported, with two identical purchases on
+# 2024-01-05 and a description the credit card rules recategorize
+PURCHASES = [
+    ('2024-01-02', 'WEGMANS #12', 'Dining', 54.10),
+    ('2024-01-03', 'SHELL OIL', 'Gas/Automotive', 40.00),
+    ('2024-01-05', 'COFFEE SHOP', 'Dining', 4.75),
+    ('2024-01-05', 'COFFEE SHOP', 'Dining', 4.75),
+    ('2024-01-05', 'BOOK STORE', 'Merchandise', 22.99),
+    ('2024-01-08', 'GIANT 0042', 'Merchandise', 81.30),
+    ('2024-01-08', 'PHARMACY', 'Health Care', 12.00),
+    ('2024-01-11', 'SHELL OIL', 'Gas/Automotive', 38.50),
+    ('2024-01-14', 'COFFEE SHOP', 'Dining', 4.75),
+    ('2024-01-14', 'RESTAURANT', 'Dining', 61.20),
+]
+TOTAL = round(sum(debit for *_, debit in PURCHASES) * 100)
+
+
+def export(path, purchases, descending=False):
+    '''
+    Write the purchases as a credit card export, newest first like the bank
+    exports them when descending is set
+    '''
+    df = pd.DataFrame(purchases, columns=['Transaction Date', 'Description', 'Category', 'Debit'])
+    df.insert(1, 'Posted Date', df['Transaction Date'])
+    df.insert(2, 'Card No.', 1234)
+    df['Credit'] = float('nan')
+    if descending:
+        df = df.iloc[::-1]
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    df.to_csv(path, index=False)
+
+
+def upload(data_dir, *exports, chunksize=None):
+    for name, purchases in exports:
+        export(data_dir / 'credit_card_data' / name, purchases)
+    utils.extract_credit_card_data(chunksize=chunksize)
+
+
+def test_reuploading_overlapping_export_adds_each_row_once(data_dir):
+    upload(data_dir, ('first.csv', PURCHASES[:7]))
+    upload(data_dir, ('second.csv', PURCHASES[2:]))
+    upload(data_dir, ('again.csv', PURCHASES))
+
+    ledger = storage.read_ledger('credit_card_data')
+    assert len(ledger) == len(PURCHASES)
+    assert ledger['Debit'].sum() == TOTAL
+    assert (ledger['Category'] == 'Groceries').sum() == 2
+
+
+def test_overlapping_exports_in_one_upload_add_each_row_once(data_dir):
+    upload(data_dir, ('first.csv', PURCHASES[:7]), ('second.csv', PURCHASES[2:]))
+
+    assert len(storage.read_ledger('credit_card_data')) == len(PURCHASES)
+
+
+def test_rollup_counts_reuploaded_rows_once(data_dir):
+    upload(data_dir, ('first.csv', PURCHASES[:7]))
+    utils.get_summary(True)
+    upload(data_dir, ('second.csv', PURCHASES))
+
+    assert storage.read_ledger('monthly_rollup')['Amount'].sum() == TOTAL
+
+
+def imported(data_dir, chunksize=None):
+    export(data_dir / 'credit_card_data' / 'export.csv', PURCHASES, descending=True)
+    utils.extract_credit_card_data(chunksize=chunksize)
+    utils.get_summary(True)
+
+    return (storage.read_ledger('credit_card_data').reset_index(drop=True),
+            storage.read_ledger('monthly_rollup')['Amount'].sum())
+
+
+@pytest.mark.parametrize('chunksize', [1, 2, 4])
+def test_chunked_import_of_descending_export_matches_full_import(data_dir, monkeypatch, chunksize):
+    full, full_rollup = imported(data_dir)
+
+    # small chunks split the purchases of a day, including the repeated ones,
+    # across chunks
+    monkeypatch.setattr(storage, 'DATA_PATH', str(data_dir / 'chunked'))
+    storage.clear_ledger_cache()
+    chunked, chunked_rollup = imported(data_dir / 'chunked', chunksize=chunksize)
+
+    pd.testing.assert_frame_equal(chunked, full)
+    assert chunked_rollup == full_rollup == TOTAL
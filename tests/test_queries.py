@@ -0,0 +1,144 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import src.storage as storage
+import src.utils as utils
+
+
+def deductions():
+    '''
+    A couple of years of deductions, several on most days and written in two
+    batches so the last value of a day depends on the write order
+    '''
+    rng = np.random.default_rng(7)
+    days = pd.to_datetime(rng.integers(pd.Timestamp('2023-01-01').value // 86400_000_000_000,
+                                       pd.Timestamp('2024-12-31').value // 86400_000_000_000, 600), unit='D')
+    df = pd.DataFrame({
+        'Date': days,
+        'Amount': rng.integers(100, 100000, len(days)),
+        'Category': rng.choice(['Rent', 'Credit Card', 'Misc', 'Tuition'], len(days)),
+    })
+
+    return df.sort_values('Date', kind='stable', ignore_index=True)
+
+
+# the backend and layout of each store the queries are compared over
+STORES = {'csv': ('csv', 'flat'), 'sqlite': ('sqlite', 'flat'), 'monthly': ('csv', 'monthly')}
+
+
+@pytest.fixture
+def stores(data_dir, monkeypatch):
+    '''
+    Write the same deductions to every store, returning a function that
+    switches to one of them
+    '''
+    def use(name):
+        backend, layout = STORES[name]
+        monkeypatch.setattr(storage, 'STORAGE_BACKEND', backend)
+        monkeypatch.setattr(storage, 'STORAGE_LAYOUT', layout)
+        monkeypatch.setattr(storage, 'DATA_PATH', str(data_dir / name))
+        storage.clear_ledger_cache()
+
+    df = deductions()
+    for name in STORES:
+        (data_dir / name).mkdir()
+        use(name)
+        storage.write_ledger('deductions', df.iloc[::2])
+        storage.write_ledger('deductions', df.iloc[1::2])
+
+    return use
+
+
+@pytest.fixture
+def backends(stores):
+    '''
+    Run an aggregate query against one of the stores
+    '''
+    def query(name, *args, **kwargs):
+        stores(name)
+        return utils.aggregate_ledger('deductions', *args, **kwargs)
+
+    return query
+
+
+def in_key_order(df):
+    '''
+    Sort the aggregate by its keys, pandas orders categories the way the
+    ledger declares them while sqlite orders them by name
+    '''
+    if 'Category' in df.columns:
+        df = df.astype({'Category': str})
+    keys = [column for column in ('Category', 'Date') if column in df.columns]
+
+    return df.sort_values(keys, ignore_index=True)
+
+
+@pytest.mark.parametrize('store', ['sqlite', 'monthly'])
+@pytest.mark.parametrize('agg', ['sum', 'last'])
+@pytest.mark.parametrize('freq', ['D', 'W', 'ME'])
+@pytest.mark.parametrize('by', [('Category',), ()])
+def test_aggregates_match_csv(backends, store, by, freq, agg):
+    csv = backends('csv', 'Amount', by=by, freq=freq, agg=agg)
+    other = backends(store, 'Amount', by=by, freq=freq, agg=agg)
+
+    pd.testing.assert_frame_equal(in_key_order(other), in_key_order(csv))
+
+
+@pytest.mark.parametrize('store', ['sqlite', 'monthly'])
+@pytest.mark.parametrize('window', [
+    dict(start='2023-03-15', end='2024-02-29', end_inclusive=True),
+    dict(start=pd.Timestamp('2024-02-01'), end=pd.Timestamp('2024-03-01'), end_inclusive=False),
+    dict(start=pd.Timestamp('2025-02-01'), end=pd.Timestamp('2025-03-01'), end_inclusive=False),
+])
+def test_windows_match_csv(backends, store, window):
+    csv = backends('csv', 'Amount', freq='W', **window)
+    other = backends(store, 'Amount', freq='W', **window)
+
+    pd.testing.assert_frame_equal(in_key_order(other), in_key_order(csv))
+
+
+@pytest.mark.parametrize('store', ['sqlite', 'monthly'])
+def test_date_span_matches_csv(stores, store):
+    stores('csv')
+    span = utils.ledger_date_span('deductions')
+    stores(store)
+
+    assert utils.ledger_date_span('deductions') == span
+
+
+def test_monthly_window_only_reads_its_months(stores, monkeypatch):
+    stores('monthly')
+    read = storage.CsvBackend.read
+    stems = []
+
+    def recording_read(self, stem, columns=None):
+        stems.append((stem, columns))
+        return read(self, stem, columns=columns)
+
+    monkeypatch.setattr(storage.CsvBackend, 'read', recording_read)
+    utils.aggregate_ledger('deductions', 'Amount', start=pd.Timestamp('2024-02-01'), end=pd.Timestamp('2024-03-01'), end_inclusive=False)
+
+    assert [os.path.relpath(stem, storage.DATA_PATH) for stem, _ in stems] == [os.path.join('deductions', '2024', '02')]
+    assert sorted(stems[0][1]) == ['Amount', 'Category', 'Date']
+
+
+def test_monthly_listing_kept_until_a_month_is_added(stores, data_dir, monkeypatch):
+    stores('monthly')
+    layout, backend = storage.get_layout(), storage.get_backend()
+
+    # age the directories so the listing isn't taken as racing a write
+    root = data_dir / 'monthly' / 'deductions'
+    for path in [root, *root.iterdir()]:
+        os.utime(path, ns=(10**18, 10**18))
+    months = layout.months(backend, 'deductions')
+
+    scandir = os.scandir
+    monkeypatch.setattr(os, 'scandir', None)
+    assert layout.months(backend, 'deductions') == months
+    monkeypatch.setattr(os, 'scandir', scandir)
+
+    storage.write_ledger('deductions', deductions().iloc[:1].assign(Date=pd.Timestamp('2025-01-10')))
+    assert layout.months(backend, 'deductions') == months + [(2025, 1)]
@@ -0,0 +1,122 @@
+import os
+
+import pandas as pd
+import pytest
+
+import src.storage as storage
+
+
+def rows(*days):
+    return pd.DataFrame({'Date': pd.to_datetime(list(days)), 'Amount': [100] * len(days), 'Category': ['Misc'] * len(days)})
+
+
+def test_store_read_racing_a_write_holds_rows_once(data_dir, monkeypatch):
+    storage.write_ledger('deductions', rows('2024-01-01'))
+
+    # a writer puts its rows on disk while the store reads the ledger, and
+    # only hands them to apply once the read is done
+    read_ledger = storage.read_ledger
+    pending = []
+
+    def read_during_write(ledger, *args, **kwargs):
+        if not pending:
+            new = rows('2024-01-02')
+            before = storage.ledger_version(ledger)
+            storage._write(storage.get_backend(), storage.get_layout(), ledger, new)
+            pending.append((new, before, storage.ledger_version(ledger)))
+        return read_ledger(ledger, *args, **kwargs)
+
+    monkeypatch.setattr(storage, 'read_ledger', read_during_write)
+    storage.ledger_store.get('deductions')
+    monkeypatch.setattr(storage, 'read_ledger', read_ledger)
+    storage.ledger_store.apply('deductions', *pending[0])
+
+    _, df = storage.ledger_store.get('deductions')
+    assert len(df) == len(storage.read_ledger('deductions')) == 2
+
+
+def test_append_after_torn_row_drops_it(data_dir):
+    storage.write_ledger('deductions', rows('2024-01-01', '2024-01-02'))
+
+    # a crash part way through an append leaves half a row behind
+    path = data_dir / 'deductions.csv'
+    with open(path, 'a') as f:
+        f.write('2024-01-0')
+    storage.clear_ledger_cache()
+    assert storage.read_ledger('deductions')['Date'].tolist() == list(pd.to_datetime(['2024-01-01', '2024-01-02']))
+
+    storage.write_ledger('deductions', rows('2024-01-03'))
+    storage.clear_ledger_cache()
+
+    assert path.read_text().endswith('\n2024-01-03,1.0,Misc\n')
+    assert storage.read_ledger('deductions')['Date'].tolist() == list(pd.to_datetime(['2024-01-01', '2024-01-02', '2024-01-03']))
+
+
+def test_store_write_drops_stale_cached_frame(data_dir):
+    storage.write_ledger('deductions', rows('2024-01-01'))
+    _, held = storage.ledger_store.get('deductions')
+    cached = lambda: [df for _, df in storage._ledger_cache.values()]
+    assert any(df is held for df in cached())
+
+    storage.write_ledger('deductions', rows('2024-01-02'))
+    _, held = storage.ledger_store.get('deductions')
+
+    assert len(held) == 2
+    assert all(len(df) == 2 for df in cached())
+
+
+@pytest.fixture
+def parquet(data_dir, monkeypatch):
+    pytest.importorskip('pyarrow')
+    monkeypatch.setattr(storage, 'STORAGE_BACKEND', 'parquet')
+    monkeypatch.setattr(storage, 'PARQUET_PARTS', 3)
+    return storage.get_backend(), str(data_dir / 'deductions')
+
+
+def days(n):
+    return [str(day.date()) for day in pd.date_range('2024-01-01', periods=n)]
+
+
+def test_parquet_parts_merged_past_the_limit(parquet):
+    backend, stem = parquet
+    for day in days(10):
+        storage.write_ledger('deductions', rows(day))
+
+    assert len(backend.parts(stem)) <= 4
+    assert os.path.basename(backend.parts(stem)[0]).startswith('base-')
+    assert storage.read_ledger('deductions')['Date'].tolist() == list(pd.to_datetime(days(10)))
+
+
+def test_parquet_read_racing_a_merge_reads_rows_once(parquet, monkeypatch):
+    backend, stem = parquet
+    for day in days(3):
+        storage.write_ledger('deductions', rows(day))
+
+    # the parts listed by the reader are merged and removed before it opens
+    # them
+    read_parts = backend.read_parts
+    merged = []
+
+    def merge_then_read(parts, columns=None):
+        if not merged:
+            merged.append(parts)
+            backend.compact(stem)
+        return read_parts(parts, columns)
+
+    monkeypatch.setattr(backend, 'read_parts', merge_then_read)
+    assert backend.read(stem)['Date'].tolist() == list(pd.to_datetime(days(3)))
+    assert len(backend.parts(stem)) == 1
+
+
+def test_parquet_merge_converts_dollar_parts(parquet):
+    backend, stem = parquet
+
+    # a part written before money was stored as cents
+    os.makedirs(f'{stem}.parquet')
+    rows('2024-01-01').assign(Amount=1.0).to_parquet(f'{stem}.parquet/part-{0:020d}.parquet', index=False)
+    storage.write_ledger('deductions', rows('2024-01-02'))
+    backend.compact(stem)
+
+    assert len(backend.parts(stem)) == 1
+    assert backend.dollar_parts(backend.parts(stem)) == []
+    assert storage.read_ledger('deductions')['Amount'].tolist() == [100, 100]
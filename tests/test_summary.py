@@ -0,0 +1,184 @@
+import math
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import src.utils as utils
+
+
+LOOKBACKS = [0, 1, 2, 3, 6, 12, 30]
+
+
+def transactions(months, categories, seed):
+    '''
+    Build a few transactions in cents for every category in each of the
+    given months
+    '''
+    rng = np.random.default_rng(seed)
+    rows = []
+    for month in months:
+        start = pd.Timestamp(month)
+        for category in categories:
+            for _ in range(rng.integers(1, 4)):
+                day = start + pd.Timedelta(days=int(rng.integers(0, start.days_in_month)))
+                rows.append((day, int(rng.integers(100, 500000)), category))
+
+    df = pd.DataFrame(rows, columns=['Date', 'Amount', 'Category'])
+    return df.sort_values('Date', kind='stable', ignore_index=True)
+
+
+def bank_history():
+    '''
+    Additions and deductions with months missing entirely, months missing a
+    category, and a latest additions month without any Paycheck
+    '''
+    months = pd.date_range('2023-01-01', '2024-12-01', freq='MS')
+
+    # nothing at all in 2023-04 and 2024-02, no paycheck in 2023-09 or in the
+    # latest month
+    add_months = [month for month in months if month.strftime('%Y-%m') not in ('2023-04', '2024-02')]
+    paycheck_months = [month for month in add_months if month.strftime('%Y-%m') not in ('2023-09', '2024-12')]
+    additions = pd.concat([
+        transactions(paycheck_months, ['Paycheck'], seed=1),
+        transactions(add_months, ['Misc', 'Transfer'], seed=2),
+    ]).sort_values('Date', kind='stable', ignore_index=True)
+
+    # deductions stop a month before the additions, skip 2023-06 entirely and
+    # only pay rent every other month
+    ded_months = [month for month in months[:-1] if month.strftime('%Y-%m') != '2023-06']
+    deductions = pd.concat([
+        transactions(ded_months[::2], ['Rent'], seed=3),
+        transactions(ded_months, ['Credit Card', 'Misc', 'Transfer', 'Tuition'], seed=4),
+    ]).sort_values('Date', kind='stable', ignore_index=True)
+
+    return additions, deductions
+
+
+def lookback(df, n_months):
+    '''
+    The rows from the first of the latest month in the ledger, going back a
+    number of months before it
+    '''
+    latest = df['Date'].max()
+    start = pd.Timestamp(latest.year, latest.month, 1)
+    if n_months:
+        return df[df['Date'] >= start - pd.DateOffset(months=n_months)]
+    return df[(df['Date'] >= start) & (df['Date'] < start + pd.DateOffset(months=1))]
+
+
+def monthly_mean(df):
+    '''
+    Average the monthly sums, counting the months in between without any rows
+    as zero
+    '''
+    return np.mean(df.groupby(pd.Grouper(key='Date', freq='ME'))['Amount'].sum())
+
+
+def reference(additions, deductions, cum_type, n_months):
+    '''
+    The summary computed straight from the transactions, each ledger looking
+    back from its own latest month. A window without any Paycheck gives 0
+    income when summing and NaN when averaging
+    '''
+    added = lookback(additions, n_months)
+    added = added[added['Category'] != 'Transfer']
+    spent = lookback(deductions, n_months)
+    paychecks = added[added['Category'] == 'Paycheck']
+
+    if cum_type:
+        income = paychecks['Amount'].sum()
+        rent, credit, misc = (spent.loc[spent['Category'] == category, 'Amount'].sum()
+                              for category in ('Rent', 'Credit Card', 'Misc'))
+        saved = added['Amount'].sum() - spent['Amount'].sum()
+    else:
+        income = monthly_mean(paychecks)
+        rent, credit, misc = (monthly_mean(spent[spent['Category'] == category])
+                              if (spent['Category'] == category).any() else 0
+                              for category in ('Rent', 'Credit Card', 'Misc'))
+        saved = monthly_mean(added) - monthly_mean(spent)
+
+    return {'income': income, 'rent': rent, 'credit': credit, 'misc': misc, 'saved': saved}
+
+
+def assert_matches(summary, expected):
+    assert summary.keys() == expected.keys()
+    for key, value in expected.items():
+        got = summary[key]
+        if math.isnan(value):
+            assert math.isnan(got), key
+        else:
+            assert got == pytest.approx(float(value), abs=1e-6), key
+
+
+@pytest.mark.parametrize('n_months', LOOKBACKS)
+@pytest.mark.parametrize('cum_type', [True, False])
+def test_summary_matches_reference_on_rebuilt_rollup(data_dir, cum_type, n_months):
+    additions, deductions = bank_history()
+    utils.write_transactions('additions', additions)
+    utils.write_transactions('deductions', deductions)
+
+    assert_matches(utils.get_summary(cum_type, n_months), reference(additions, deductions, cum_type, n_months))
+
+
+@pytest.mark.parametrize('n_months', LOOKBACKS)
+@pytest.mark.parametrize('cum_type', [True, False])
+def test_summary_matches_reference_on_appended_rollup(data_dir, cum_type, n_months):
+    additions, deductions = bank_history()
+    split = pd.Timestamp('2024-06-15')
+
+    # the rollup is built from the first half, the second half is added to it
+    # as it is written
+    utils.write_transactions('additions', additions[additions['Date'] < split])
+    utils.write_transactions('deductions', deductions[deductions['Date'] < split])
+    utils.get_summary(cum_type, n_months)
+    utils.write_transactions('additions', additions[additions['Date'] >= split])
+    utils.write_transactions('deductions', deductions[deductions['Date'] >= split])
+
+    assert_matches(utils.get_summary(cum_type, n_months), reference(additions, deductions, cum_type, n_months))
+
+
+def test_latest_month_without_paycheck(data_dir):
+    additions, deductions = bank_history()
+    utils.write_transactions('additions', additions)
+    utils.write_transactions('deductions', deductions)
+
+    assert not lookback(additions, 0)['Category'].eq('Paycheck').any()
+    assert utils.get_summary(True, 0)['income'] == 0
+    assert math.isnan(utils.get_summary(False, 0)['income'])
+
+
+def test_summary_without_bank_data(data_dir):
+    assert utils.get_summary(True) == {'income': 0.0, 'rent': 0, 'credit': 0, 'misc': 0, 'saved': 0.0}
+
+
+def test_rollup_rebuilt_during_write_counts_rows_once(data_dir, monkeypatch):
+    additions, deductions = bank_history()
+    utils.write_transactions('additions', additions)
+
+    # a summary asked for while the deductions are being written must not
+    # rebuild the rollup from the new rows and then have them added again
+    write_ledger = utils.write_ledger
+    threads = []
+
+    def write_then_summarize(ledger, df, keys=None):
+        written = write_ledger(ledger, df, keys=keys)
+        if ledger == 'deductions':
+            thread = threading.Thread(target=utils.get_summary, args=(True, 30))
+            thread.start()
+            thread.join(timeout=0.5)
+            threads.append(thread)
+        return written
+
+    monkeypatch.setattr(utils, 'write_ledger', write_then_summarize)
+    utils.write_transactions('deductions', deductions)
+    monkeypatch.setattr(utils, 'write_ledger', write_ledger)
+    for thread in threads:
+        thread.join()
+
+    spent = deductions.groupby('Category')['Amount'].sum()
+    summary = utils.get_summary(True, 30)
+    assert summary['rent'] == spent['Rent']
+    assert summary['credit'] == spent['Credit Card']
+    assert summary['misc'] == spent['Misc']